@@ -1,15 +1,33 @@
 import os
+import io
+import re
+import csv
 import json
+import base64
+import zlib
+import zipfile
 import secrets
-from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, session, send_from_directory
+import hashlib
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from bisect import bisect_right
+from collections import namedtuple
+from types import MappingProxyType
+import click
+from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, session, send_from_directory, make_response, stream_with_context
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from models import db, User, Order, Notification, Payment, Customer, Price, Feedback, Log, Coupon, UserLog, MemberPlan, MemberOrder, CustomerMember, CustomerGift, GiftProduct, GiftOrder, get_level_and_discount, PlayerPrice, CustomOfferRequest, GameNews, PendingTaskRequest, ContactSetting, CustomerServiceMessage, Announcement, Faq
+from werkzeug.datastructures import FileStorage
+from models import db, User, Order, Notification, Payment, Customer, Price, Feedback, Log, Coupon, UserLog, MemberPlan, MemberOrder, CustomerMember, CustomerGift, GiftProduct, GiftOrder, get_level_and_discount, PlayerPrice, CustomOfferRequest, GameNews, PendingTaskRequest, ContactSetting, CustomerServiceMessage, Announcement, Faq, DispatchJob, DispatchBatch, PlayerMonthlyCompletion, DailyStat, PlayerStats, PlayerGame, SiteCounter, ImportJob, ParseCache
 from forms import LoginForm, OrderForm, FeedbackForm, PlayerEditForm
 from datetime import datetime, timedelta
 from flask import abort
 from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm.exc import StaleDataError
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or 'your-secret-key-change-this'
@@ -26,7 +44,8 @@ UPLOAD_WECHAT_DIR = os.path.join(app.config['UPLOAD_FOLDER'], 'wechat')
 UPLOAD_ALIPAY_DIR = os.path.join(app.config['UPLOAD_FOLDER'], 'alipay')
 UPLOAD_PRICE_TABLE_DIR = os.path.join(app.config['UPLOAD_FOLDER'], 'price_table')
 UPLOAD_BG_DIR = os.path.join(app.config['UPLOAD_FOLDER'], 'bg')
-for d in (UPLOAD_WECHAT_DIR, UPLOAD_ALIPAY_DIR, UPLOAD_PRICE_TABLE_DIR, UPLOAD_BG_DIR):
+UPLOAD_IMPORT_JOB_DIR = os.path.join(app.config['UPLOAD_FOLDER'], 'import_jobs')
+for d in (UPLOAD_WECHAT_DIR, UPLOAD_ALIPAY_DIR, UPLOAD_PRICE_TABLE_DIR, UPLOAD_BG_DIR, UPLOAD_IMPORT_JOB_DIR):
     os.makedirs(d, exist_ok=True)
 SITE_IMAGE_EXT = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
 SITE_IMAGE_KEYS = {
@@ -47,6 +66,41 @@ ANIME_GAMES_CUSTOMER_OFFER = [
 ]
 ANIME_CUSTOMER_OFFER_COMMISSION = 0.20  # 平台抽成 20%，打手得 80%
 ANIME_PRICE_MARKUP = 1.20  # 完成后录入平台价 = 顾客报价 × 1.2
+# 批量派单时每位打手最多同时进行的订单数；每次求解的订单数（积压更多时按下单时间分段求解，限制单次指派规模）
+DISPATCH_MAX_ONGOING = int(os.environ.get('DISPATCH_MAX_ONGOING', '5'))
+DISPATCH_BATCH_CHUNK = int(os.environ.get('DISPATCH_BATCH_CHUNK', '300'))
+# 派单队列：进程内 worker 线程数（0 表示只用独立进程 flask dispatch-worker）、每批取的任务数、冲突重试次数、空闲轮询间隔（秒）。
+# 生产环境推荐设为 0，另用 supervisor/systemd 常驻运行 flask --app app dispatch-worker；进程内线程随应用启动拉起，便于单机部署
+DISPATCH_WORKER_THREADS = int(os.environ.get('DISPATCH_WORKER_THREADS', '1'))
+DISPATCH_BATCH_SIZE = int(os.environ.get('DISPATCH_BATCH_SIZE', '20'))
+DISPATCH_MAX_ATTEMPTS = int(os.environ.get('DISPATCH_MAX_ATTEMPTS', '3'))
+DISPATCH_POLL_SECONDS = float(os.environ.get('DISPATCH_POLL_SECONDS', '5'))
+# 价格表识别任务：进程内调度线程数（0 表示只用独立进程 flask import-worker）、解析进程数（0 表示在调度线程内直接解析）、空闲轮询间隔（秒）
+IMPORT_WORKER_THREADS = int(os.environ.get('IMPORT_WORKER_THREADS', '1'))
+IMPORT_WORKER_PROCESSES = int(os.environ.get('IMPORT_WORKER_PROCESSES', '2'))
+IMPORT_POLL_SECONDS = float(os.environ.get('IMPORT_POLL_SECONDS', '5'))
+# PDF 并行解析：进程数（1 表示逐页解析）、页数少于 PDF_PARSE_MIN_PAGES 时不值得开进程，仍逐页解析
+PDF_PARSE_WORKERS = int(os.environ.get('PDF_PARSE_WORKERS', '1'))
+PDF_PARSE_MIN_PAGES = int(os.environ.get('PDF_PARSE_MIN_PAGES', '4'))
+# 解析缓存总大小上限（字节，按解析结果 JSON 计），超出时按最近使用时间淘汰
+PARSE_CACHE_MAX_BYTES = int(os.environ.get('PARSE_CACHE_MAX_BYTES', str(20 * 1024 * 1024)))
+# OCR 预处理：是否启用（灰度/缩放/二值化/分块）、缩放后最大宽度（像素）、
+# 超过 OCR_TILE_HEIGHT 的长截图切成重叠 OCR_TILE_OVERLAP 像素的横向分块并行识别
+OCR_PREPROCESS = os.environ.get('OCR_PREPROCESS', '1') != '0'
+OCR_MAX_WIDTH = int(os.environ.get('OCR_MAX_WIDTH', '1600'))
+OCR_TILE_HEIGHT = int(os.environ.get('OCR_TILE_HEIGHT', '1400'))
+OCR_TILE_OVERLAP = int(os.environ.get('OCR_TILE_OVERLAP', '120'))
+OCR_TILE_WORKERS = int(os.environ.get('OCR_TILE_WORKERS', '4'))
+# OCR 常驻进程池：进程数（0 表示在当前进程内识别）、允许排队等待的任务数（超出则最多等 OCR_QUEUE_TIMEOUT 秒）。
+# 只在调度进程内直接解析（IMPORT_WORKER_PROCESSES=0）时使用；解析子进程内一律就地识别，见「OCR 常驻进程池」一节
+OCR_POOL_PROCESSES = int(os.environ.get('OCR_POOL_PROCESSES', '2'))
+OCR_QUEUE_SIZE = int(os.environ.get('OCR_QUEUE_SIZE', '8'))
+OCR_QUEUE_TIMEOUT = float(os.environ.get('OCR_QUEUE_TIMEOUT', '60'))
+# 热门打手：排行快照最长保留秒数（到期重建）、公开页面允许浏览器/CDN 缓存的秒数
+HOT_PLAYERS_TTL = float(os.environ.get('HOT_PLAYERS_TTL', '300'))
+HOT_PLAYERS_MAX_AGE = int(os.environ.get('HOT_PLAYERS_MAX_AGE', '60'))
+# 流式导出：每批从数据库游标取的行数
+EXPORT_YIELD_PER = int(os.environ.get('EXPORT_YIELD_PER', '1000'))
 
 
 def player_price_to_platform_price(player_price):
@@ -65,20 +119,7 @@ def platform_price_from_player_request(player_price, player):
         return 0
     if not player:
         return player_price_to_platform_price(player_price)
-    mode = (player.income_mode or 'fixed').strip()
-    if mode == 'fixed':
-        return player_price_to_platform_price(player_price)
-    if mode == 'percentage':
-        try:
-            data = json.loads(player.tiered_rates) if player.tiered_rates else {}
-            rate = data.get('rate', 80)
-            rate = max(1, min(100, rate)) / 100
-            return round(player_price / rate, 2)
-        except (json.JSONDecodeError, TypeError, KeyError, ValueError):
-            return round(player_price / 0.8, 2)
-    if mode == 'tiered':
-        return round(player_price / 0.75, 2)
-    return player_price_to_platform_price(player_price)
+    return get_income_strategy(player).platform_price(player_price)
 
 
 def _normalize_task(s):
@@ -89,32 +130,191 @@ def _normalize_task(s):
     return s[:50]
 
 
-def _find_platform_price_fuzzy(game, task_type):
-    """先精确匹配，再同 game 下模糊匹配 task_type（包含/被包含/归一化后相等）。返回 Price 或 None。"""
+class TaskMatchIndex:
+    """同一游戏下 task_type 的模糊匹配索引，规则与逐行比较完全一致：
+    归一化并去掉 '-' 后，两者互为子串即匹配，多条命中时取最早加入的一条。
+    「平台项是查询的子串」枚举查询的全部子串查字典；「查询是平台项的子串」走单字/二元字倒排表，
+    两者都与该游戏的价格条数无关。"""
+
+    def __init__(self):
+        self._items = []  # [(去 '-' 后的归一化 key, ref)]，按加入顺序
+        self._exact = {}  # 原始 task_type -> 最早加入的 ref
+        self._by_key = {}  # key -> 最早的位置
+        self._postings = {}  # 单字/二元字 -> 递增位置列表
+        self._posting_sets = {}
+        self._wildcard = None  # 归一化后只剩 '-' 的条目：去 '-' 为空串，任何查询都包含它
+
+    def add(self, task_type, ref):
+        self._exact.setdefault(task_type, ref)
+        norm = _normalize_task(task_type)
+        if not norm:
+            return
+        key = norm.replace('-', '')
+        pos = len(self._items)
+        self._items.append((key, ref))
+        if not key:
+            if self._wildcard is None:
+                self._wildcard = pos
+            return
+        self._by_key.setdefault(key, pos)
+        for gram in set(key) | {key[i:i + 2] for i in range(len(key) - 1)}:
+            self._postings.setdefault(gram, []).append(pos)
+            self._posting_sets.setdefault(gram, set()).add(pos)
+
+    def exact(self, task_type):
+        return self._exact.get(task_type)
+
+    def match(self, task_type):
+        norm = _normalize_task(task_type)
+        if not norm or not self._items:
+            return None
+        q = norm.replace('-', '')
+        if not q:
+            return self._items[0][1]
+        best = self._wildcard
+        # 平台项是查询的子串
+        n = len(q)
+        for i in range(n):
+            for j in range(i + 1, n + 1):
+                pos = self._by_key.get(q[i:j])
+                if pos is not None and (best is None or pos < best):
+                    best = pos
+        # 查询是平台项的子串
+        grams = {q[i:i + 2] for i in range(n - 1)} or {q}
+        if all(g in self._postings for g in grams):
+            grams = sorted(grams, key=lambda g: len(self._postings[g]))
+            others = [self._posting_sets[g] for g in grams[1:]]
+            for pos in self._postings[grams[0]]:
+                if best is not None and pos >= best:
+                    break
+                if all(pos in s for s in others) and q in self._items[pos][0]:
+                    best = pos
+                    break
+        return None if best is None else self._items[best][1]
+
+
+def _match_platform_price(game, task_type, catalog, pending=None):
+    """_find_platform_price_fuzzy 的内存版：返回匹配到的 PriceEntry 或 pending 中的条目，不查库。
+    pending 为本次导入新增、尚未写库的 {game: TaskMatchIndex}，其中条目排在价格目录之后。"""
     if not game or not task_type:
         return None
-    exact = Price.query.filter_by(game=game.strip(), task_type=task_type.strip()).first()
-    if exact:
-        return exact
-    parsed_norm = _normalize_task(task_type)
-    if not parsed_norm:
-        return None
-    candidates = Price.query.filter_by(game=game.strip()).all()
-    for p in candidates:
-        platform_norm = _normalize_task(p.task_type)
-        if not platform_norm:
-            continue
-        if parsed_norm == platform_norm:
-            return p
-        if parsed_norm in platform_norm or platform_norm in parsed_norm:
-            return p
-        platform_no_dash = platform_norm.replace('-', '')
-        parsed_no_dash = parsed_norm.replace('-', '')
-        if parsed_no_dash in platform_no_dash or platform_no_dash in parsed_no_dash:
-            return p
+    game = game.strip()
+    indexes = [catalog.task_index(game)]
+    if pending and game in pending:
+        indexes.append(pending[game])
+    for index in indexes:
+        ref = index.exact(task_type.strip())
+        if ref is not None:
+            return ref
+    for index in indexes:
+        ref = index.match(task_type)
+        if ref is not None:
+            return ref
     return None
 
 
+def _find_platform_price_fuzzy(game, task_type, catalog=None):
+    """先精确匹配，再同 game 下模糊匹配 task_type（包含/被包含/归一化后相等）。返回 Price 或 None。
+    批量调用时传入同一份 catalog（价格目录快照），避免逐行查版本号。"""
+    entry = _match_platform_price(game, task_type, catalog or get_price_catalog())
+    return db.session.get(Price, entry.id) if entry else None
+
+
+# ---------- 价格目录缓存 ----------
+# 平台价格表一天只改几次，首页/下单页每次都全表查询并按游戏分组代价偏高。
+# 每个 worker 进程缓存一份不可变快照，库中 SiteCounter('price_catalog') 版本号变化时重建，
+# 因此任一 gunicorn worker 改价后，其他 worker 在下一次请求即可看到新价格。
+PRICE_CATALOG_COUNTER = 'price_catalog'
+
+PriceEntry = namedtuple('PriceEntry', ['id', 'game', 'task_type', 'price', 'unit', 'remark', 'service_type'])
+
+
+class PriceCatalog:
+    """平台价格表快照：按服务类型（代肝/陪玩）和游戏分组，并提供 (game, task_type) 查找。只读。"""
+
+    def __init__(self, version, entries):
+        self.version = version
+        self.entries = tuple(sorted(entries, key=lambda e: (e.game, e.task_type, e.id)))
+        grouped = {}
+        by_service = {}
+        lookup = {}
+        for e in self.entries:
+            # service_type 为空的历史数据按代肝处理（与原 Price.service_type.is_(None) 过滤一致）
+            service = e.service_type or '代肝'
+            grouped.setdefault(None, {}).setdefault(e.game, []).append(e)
+            grouped.setdefault(service, {}).setdefault(e.game, []).append(e)
+            by_service.setdefault(service, []).append(e)
+            lookup.setdefault((e.game, e.task_type), []).append(e)
+        self._grouped = {
+            service: MappingProxyType({g: tuple(items) for g, items in games.items()})
+            for service, games in grouped.items()
+        }
+        self._by_service = {service: tuple(items) for service, items in by_service.items()}
+        # 同一 (game, task_type) 可能有多条（不同服务类型），按 id 排序以模拟 .first()
+        self._lookup = {key: tuple(sorted(items, key=lambda e: e.id)) for key, items in lookup.items()}
+        self._task_indexes = {}
+
+    def prices(self, service_type=None):
+        """按 (game, task_type) 排序的价格条目；service_type 为 None 时返回全部。"""
+        if service_type is None:
+            return self.entries
+        return self._by_service.get(service_type, ())
+
+    def grouped(self, service_type=None):
+        """{game: (PriceEntry, ...)}，游戏按名称排序。"""
+        return self._grouped.get(service_type, MappingProxyType({}))
+
+    def games(self, service_type=None):
+        return list(self.grouped(service_type).keys())
+
+    def tasks(self, game, service_type=None):
+        return self.grouped(service_type).get(game, ())
+
+    def task_index(self, game):
+        """该游戏（不分服务类型）的 TaskMatchIndex，按 id 顺序建，首次使用时构建并随快照缓存。"""
+        index = self._task_indexes.get(game)
+        if index is None:
+            index = TaskMatchIndex()
+            for e in sorted(self.tasks(game), key=lambda e: e.id):
+                index.add(e.task_type, e)
+            self._task_indexes[game] = index
+        return index
+
+    def get(self, game, task_type, service_type=None):
+        """精确查找平台价，等价于 Price.query.filter_by(game=, task_type=[, service_type=]).first()。"""
+        for e in self._lookup.get((game, task_type), ()):
+            if service_type is None or (e.service_type or '代肝') == service_type:
+                return e
+        return None
+
+
+_price_catalog = None
+
+
+def price_catalog_version():
+    """库中价格目录版本号（每次取都查库，保证跨 worker 一致）。"""
+    return db.session.query(SiteCounter.value).filter_by(name=PRICE_CATALOG_COUNTER).scalar() or 0
+
+
+def bump_price_catalog_version():
+    """价格表有改动时调用，随调用方事务提交；提交后所有 worker 的缓存在下一次取用时重建。"""
+    _increment_counter(SiteCounter, {'name': PRICE_CATALOG_COUNTER}, value=1)
+
+
+def get_price_catalog():
+    """取当前价格目录快照；版本号未变时直接复用本进程缓存。"""
+    global _price_catalog
+    version = price_catalog_version()
+    catalog = _price_catalog
+    if catalog is None or catalog.version != version:
+        rows = db.session.query(
+            Price.id, Price.game, Price.task_type, Price.price, Price.unit, Price.remark, Price.service_type
+        ).all()
+        catalog = PriceCatalog(version, [PriceEntry(*row) for row in rows])
+        _price_catalog = catalog
+    return catalog
+
+
 def get_site_image_info(key):
     """返回 (filename, mtime, base_dir)。优先 uploads/site/，其次识别文件夹：微信→uploads/wechat/，支付宝→uploads/alipay/。"""
     if key not in SITE_IMAGE_KEYS:
@@ -196,65 +396,359 @@ db.init_app(app)
 login_manager = LoginManager()
 
 
-def calculate_player_price(order_customer_price, player, current_month_completed=None):
-    if player.income_mode == 'percentage':
+# 阶梯抽成：本月完成 <10 单 75%，10~20 单 80%，>20 单 85%（bisect_right 查档）
+TIER_THRESHOLDS = (10, 21)
+TIER_RATES = (75, 80, 85)
+
+
+class IncomeStrategy:
+    """打手收益规则的编译结果（fixed / percentage / tiered），避免每次计价都解析 tiered_rates。"""
+
+    def __init__(self, income_mode, tiered_rates):
+        self.mode = income_mode
+        # 比例抽成：报酬 = 顾客价 × num / den；解析失败时按 80%
         try:
-            data = json.loads(player.tiered_rates) if player.tiered_rates else {}
+            data = json.loads(tiered_rates) if tiered_rates else {}
             rate = data.get('rate', 80)
-            rate = max(1, min(100, rate))
-            return round(order_customer_price * rate / 100, 2)
-        except (json.JSONDecodeError, TypeError, KeyError, ValueError):
-            return round(order_customer_price * 0.8, 2)
-    elif player.income_mode == 'tiered':
-        if current_month_completed is None:
-            first_day = datetime(datetime.utcnow().year, datetime.utcnow().month, 1)
-            current_month_completed = Order.query.filter(
-                Order.player_id == player.id,
-                Order.status == '已完成',
-                Order.created_at >= first_day
-            ).count()
-        if current_month_completed < 10:
-            rate = 75
-        elif current_month_completed <= 20:
-            rate = 80
-        else:
-            rate = 85
-        return round(order_customer_price * rate / 100, 2)
-    elif player.income_mode == 'fixed':
+            self.num, self.den = max(1, min(100, rate)), 100
+        except (json.JSONDecodeError, TypeError, KeyError, ValueError, AttributeError):
+            self.num, self.den = 0.8, 1
+
+    def price(self, customer_price, current_month_completed=0):
+        """打手报酬；fixed 等模式返回 None（由个人报价决定）。"""
+        if self.mode == 'percentage':
+            return round(customer_price * self.num / self.den, 2)
+        if self.mode == 'tiered':
+            rate = TIER_RATES[bisect_right(TIER_THRESHOLDS, current_month_completed or 0)]
+            return round(customer_price * rate / 100, 2)
         return None
-    else:
+
+    def price_many(self, customer_prices, current_month_completed=0):
+        """批量计价，返回与 customer_prices 等长的列表。"""
+        if self.mode == 'percentage':
+            num, den = self.num, self.den
+            return [round(p * num / den, 2) for p in customer_prices]
+        if self.mode == 'tiered':
+            rate = TIER_RATES[bisect_right(TIER_THRESHOLDS, current_month_completed or 0)]
+            return [round(p * rate / 100, 2) for p in customer_prices]
+        return [None] * len(customer_prices)
+
+    def platform_price(self, player_price):
+        """由打手报价反推平台价，见 platform_price_from_player_request。"""
+        mode = (self.mode or 'fixed').strip()
+        if mode == 'percentage':
+            return round(player_price / (self.num / self.den), 2)
+        if mode == 'tiered':
+            return round(player_price / 0.75, 2)
+        return player_price_to_platform_price(player_price)
+
+
+# 每个 worker 进程内的收益规则缓存：(user_id, income_version) -> IncomeStrategy
+_income_strategy_cache = {}
+
+
+def get_income_strategy(player):
+    """取打手的已编译收益规则；打手资料保存时 income_version 递增，旧缓存自然失效。"""
+    key = (player.id, player.income_version or 0)
+    strategy = _income_strategy_cache.get(key)
+    if strategy is None:
+        if len(_income_strategy_cache) >= 4096:
+            _income_strategy_cache.clear()
+        strategy = IncomeStrategy(player.income_mode, player.tiered_rates)
+        _income_strategy_cache[key] = strategy
+    return strategy
+
+
+def bump_income_version(player):
+    """收益规则改动后调用（随调用方事务提交）：以 SET income_version = income_version + 1 原子递增，
+    并发保存时各得到不同的版本号，不会两次都写成 N+1 让缓存了 N+1 的 worker 一直用旧规则。"""
+    User.query.filter_by(id=player.id).update(
+        {User.income_version: func.coalesce(User.income_version, 0) + 1}, synchronize_session=False)
+    db.session.expire(player, ['income_version'])
+
+
+def calculate_player_price(order_customer_price, player, current_month_completed=None):
+    strategy = get_income_strategy(player)
+    if strategy.mode == 'tiered' and current_month_completed is None:
+        current_month_completed = _monthly_completed_counts([player.id]).get(player.id, 0)
+    return strategy.price(order_customer_price, current_month_completed)
+
+
+def _ongoing_counts(player_ids):
+    """一次分组查询返回 {player_id: 进行中订单数}。"""
+    if not player_ids:
+        return {}
+    rows = db.session.query(Order.player_id, func.count(Order.id)).filter(
+        Order.player_id.in_(player_ids),
+        Order.status == '进行中'
+    ).group_by(Order.player_id).all()
+    return {pid: cnt for pid, cnt in rows}
+
+
+def _monthly_completed_counts(player_ids):
+    """返回 {player_id: 本月已完成订单数}（阶梯抽成用），读 PlayerMonthlyCompletion 计数表。"""
+    if not player_ids:
+        return {}
+    rows = db.session.query(PlayerMonthlyCompletion.player_id, PlayerMonthlyCompletion.completed_count).filter(
+        PlayerMonthlyCompletion.player_id.in_(player_ids),
+        PlayerMonthlyCompletion.month == datetime.utcnow().strftime('%Y-%m')
+    ).all()
+    return {pid: cnt for pid, cnt in rows}
+
+
+def _increment_counter(model, keys, **deltas):
+    """按 keys 定位一行计数并原子累加（SET x = x + d），不存在时插入；随调用方事务提交。"""
+    query = model.query.filter_by(**keys)
+    values = {getattr(model, name): getattr(model, name) + delta for name, delta in deltas.items()}
+    if query.update(values, synchronize_session=False):
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(model(**keys, **deltas))
+    except IntegrityError:
+        # 并发下另一事务刚插入同一行
+        query.update(values, synchronize_session=False)
+
+
+def on_order_status_changed(order, old_status, new_status):
+    """订单状态变更时维护统计计数（与状态变更在同一事务中）。"""
+    if old_status == new_status or '已完成' not in (old_status, new_status):
+        return
+    delta = 1 if new_status == '已完成' else -1
+    if order.player_id and order.created_at:
+        _increment_counter(
+            PlayerMonthlyCompletion,
+            {'player_id': order.player_id, 'month': order.created_at.strftime('%Y-%m')},
+            completed_count=delta
+        )
+    if order.player_id:
+        # 评分只计已完成订单，撤销完成时一并扣除
+        rating = {'rating_sum': delta * order.rating, 'rating_count': delta} if order.rating is not None else {}
+        _increment_counter(PlayerStats, {'player_id': order.player_id}, completed_count=delta, **rating)
+    apply_daily_stat_change(order_daily_stat(order, status=old_status), order_daily_stat(order))
+    bump_hot_players_version()
+
+
+def change_order_status(order, old_status, new_status, **values):
+    """条件更新订单状态（compare-and-set）：仅当库中状态仍为 old_status 时才写入 new_status 及 values，
+    成功后才维护统计计数。同一状态变更被并发提交时只有一方成功，避免重复计数；返回是否成功。"""
+    values['status'] = new_status
+    changed = Order.query.filter(
+        Order.id == order.id,
+        Order.status == old_status
+    ).update(values, synchronize_session=False)
+    db.session.expire(order, list(values))
+    if changed:
+        on_order_status_changed(order, old_status, new_status)
+    return bool(changed)
+
+
+def rebuild_monthly_completion_counters():
+    """按订单表重建 PlayerMonthlyCompletion（回填/修复用），返回写入行数。"""
+    counts = {}
+    query = db.session.query(Order.player_id, Order.created_at).filter(
+        Order.status == '已完成',
+        Order.player_id.isnot(None),
+        Order.created_at.isnot(None)
+    )
+    for player_id, created_at in query.yield_per(1000):
+        key = (player_id, created_at.strftime('%Y-%m'))
+        counts[key] = counts.get(key, 0) + 1
+    PlayerMonthlyCompletion.query.delete()
+    db.session.add_all([
+        PlayerMonthlyCompletion(player_id=pid, month=month, completed_count=cnt)
+        for (pid, month), cnt in counts.items()
+    ])
+    db.session.commit()
+    return len(counts)
+
+
+def daily_stat_keys(day, game=None, service_type=None, player_id=None):
+    return {'day': day, 'game': game or '', 'service_type': service_type or '', 'player_id': player_id or 0}
+
+
+def order_daily_stat(order, **overrides):
+    """订单计入 DailyStat 的部分：(keys, {指标: 值})，尚无 created_at 时返回 None。
+    overrides 覆盖订单字段（如 status=old_status），用于算出变更前的那一份。"""
+    def field(name):
+        return overrides[name] if name in overrides else getattr(order, name)
+    created_at = field('created_at')
+    if not created_at:
         return None
+    completed = field('status') == '已完成'
+    keys = daily_stat_keys(created_at.date(), field('game'), field('service_type'), field('player_id'))
+    return keys, {
+        'order_count': 1,
+        'completed_count': 1 if completed else 0,
+        'customer_revenue': (field('customer_price') or 0) if completed else 0,
+        'player_payout': (field('player_price') or 0) if completed else 0,
+    }
+
+
+def apply_daily_stat_change(before, after):
+    """订单在 DailyStat 中的那一份由 before 变为 after（新建订单 before 为 None），
+    差额原子累加到对应行（随调用方事务提交）。"""
+    changes = {}
+    for stat, sign in ((before, -1), (after, 1)):
+        if stat is None:
+            continue
+        keys, values = stat
+        delta = changes.setdefault(tuple(keys.items()), {})
+        for name, value in values.items():
+            delta[name] = delta.get(name, 0) + sign * value
+    for keys, delta in changes.items():
+        delta = {name: value for name, value in delta.items() if value}
+        if delta:
+            _increment_counter(DailyStat, dict(keys), **delta)
+
+
+def on_gift_order_paid(gift_order):
+    """礼物订单支付成功：按支付日期计入打手当天的礼物金额，并累加打手收到的礼物总额。"""
+    _increment_counter(
+        DailyStat,
+        daily_stat_keys((gift_order.paid_at or datetime.utcnow()).date(), player_id=gift_order.player_id),
+        gift_amount=gift_order.amount or 0
+    )
+    _increment_counter(PlayerStats, {'player_id': gift_order.player_id}, gift_total=gift_order.amount or 0)
+
+
+def move_daily_stats_to_unassigned(player_id):
+    """打手被删除、其订单改为未分配时，把该打手的 DailyStat 行并入 player_id=0 的对应行。"""
+    for row in DailyStat.query.filter_by(player_id=player_id).all():
+        _increment_counter(
+            DailyStat,
+            daily_stat_keys(row.day, row.game, row.service_type),
+            order_count=row.order_count, completed_count=row.completed_count,
+            customer_revenue=row.customer_revenue, player_payout=row.player_payout,
+            gift_amount=row.gift_amount
+        )
+        db.session.delete(row)
+
+
+def rebuild_daily_stats():
+    """按订单表与已支付礼物订单重建 DailyStat（回填/修复用），返回写入行数。"""
+    stats = {}
+    query = db.session.query(
+        Order.created_at, Order.game, Order.service_type, Order.player_id,
+        Order.status, Order.customer_price, Order.player_price
+    ).filter(Order.created_at.isnot(None))
+    for row in query.yield_per(1000):
+        keys, values = order_daily_stat(row)
+        stat = stats.setdefault(tuple(keys.items()), {})
+        for name, value in values.items():
+            stat[name] = stat.get(name, 0) + value
+    gifts = db.session.query(GiftOrder.paid_at, GiftOrder.player_id, GiftOrder.amount).filter(
+        GiftOrder.status == 'paid',
+        GiftOrder.paid_at.isnot(None)
+    )
+    for paid_at, player_id, amount in gifts.yield_per(1000):
+        stat = stats.setdefault(tuple(daily_stat_keys(paid_at.date(), player_id=player_id).items()), {})
+        stat['gift_amount'] = stat.get('gift_amount', 0) + (amount or 0)
+    DailyStat.query.delete()
+    db.session.add_all([DailyStat(**dict(keys), **values) for keys, values in stats.items()])
+    db.session.commit()
+    return len(stats)
+
+
+PLAYER_STATS_FIELDS = ('completed_count', 'rating_sum', 'rating_count', 'gift_total')
+
+
+def check_player_stats(repair=False):
+    """按订单表、礼物表分组重算打手口碑计数并与 PlayerStats 比对，
+    返回 [(player_id, 字段, 计数表中的值, 重算值), ...]；repair 为真时按重算值修正并提交。"""
+    expected = {}
+    orders = db.session.query(
+        Order.player_id, func.count(Order.id), func.coalesce(func.sum(Order.rating), 0), func.count(Order.rating)
+    ).join(User, User.id == Order.player_id).filter(Order.status == '已完成').group_by(Order.player_id)
+    for player_id, completed, rating_sum, rating_count in orders:
+        expected[player_id] = {'completed_count': completed, 'rating_sum': rating_sum, 'rating_count': rating_count}
+    gifts = db.session.query(
+        CustomerGift.player_id, func.coalesce(func.sum(CustomerGift.amount), 0)
+    ).join(User, User.id == CustomerGift.player_id).group_by(CustomerGift.player_id)
+    for player_id, total in gifts:
+        expected.setdefault(player_id, {})['gift_total'] = float(total)
+    rows = {row.player_id: row for row in PlayerStats.query.all()}
+    drift = []
+    for player_id in sorted(set(expected) | set(rows)):
+        want = {name: expected.get(player_id, {}).get(name, 0) for name in PLAYER_STATS_FIELDS}
+        row = rows.get(player_id)
+        have = {name: (getattr(row, name) or 0) if row else 0 for name in PLAYER_STATS_FIELDS}
+        wrong = [name for name in PLAYER_STATS_FIELDS if abs(have[name] - want[name]) > 0.005]
+        drift.extend((player_id, name, have[name], want[name]) for name in wrong)
+        if repair and wrong:
+            if row is None:
+                db.session.add(PlayerStats(player_id=player_id, **want))
+            else:
+                for name in wrong:
+                    setattr(row, name, want[name])
+    if repair:
+        db.session.commit()
+    return drift
 
 
-def auto_assign_order(order_id):
-    """自动分配订单：选择使平台利润（顾客价 - 打手报酬）最高的打手；同利润时优先分配给出勤更少的打手。"""
-    order = Order.query.get(order_id)
-    if not order or order.player_id is not None or order.status != '待分配':
-        return False
-    players = User.query.filter_by(role='player', is_approved=True).all()
-    if not players:
-        return False
+def player_stats_map(player_ids):
+    """返回 {player_id: PlayerStats}，一次查询；没有计数行的打手不在结果中。"""
+    if not player_ids:
+        return {}
+    return {row.player_id: row for row in PlayerStats.query.filter(PlayerStats.player_id.in_(player_ids)).all()}
+
+
+def _player_price_map(player_ids, tasks):
+    """一次查询返回 {(player_id, game, task_type): 打手报价}，tasks 为 [(game, task_type), ...]。"""
+    tasks = {(g, t) for g, t in tasks}
+    if not player_ids or not tasks:
+        return {}
+    games = {g for g, _ in tasks}
+    task_types = {t for _, t in tasks}
+    rows = db.session.query(PlayerPrice.player_id, PlayerPrice.game, PlayerPrice.task_type, PlayerPrice.price).filter(
+        PlayerPrice.player_id.in_(player_ids),
+        PlayerPrice.game.in_(games),
+        PlayerPrice.task_type.in_(task_types)
+    ).all()
+    return {(pid, g, t): price for pid, g, t, price in rows if (g, t) in tasks}
+
+
+def _dispatch_reward(order, player, completed, price_map):
+    """打手接 order 的预计报酬（内存版 get_player_expected_reward）。"""
     customer_price = order.customer_price or 0
-    if customer_price <= 0:
-        return False
-    # 计算每位打手接单的平台利润 = 顾客价 - 打手报酬
+    reward = get_income_strategy(player).price(customer_price, completed.get(player.id, 0))
+    if reward is None:
+        reward = price_map.get((player.id, order.game, order.task_type), 0)
+    return reward
+
+
+def _score_dispatch_candidates(order, players, ongoing, completed, price_map, reputation=None):
+    """在内存中为 order 计算候选打手，返回按（平台利润降序、进行中数量升序）排好序的
+    [(profit, -ongoing, player_id, reward), ...]。规则与 get_player_expected_reward 一致。
+    传入 reputation（{player_id: PlayerStats}）时，前两项相同再按平均评分、累计完成数降序。"""
+    customer_price = order.customer_price or 0
+    reputation = reputation or {}
+
+    def standing(player_id):
+        stats = reputation.get(player_id)
+        return ((stats.avg_rating or 0), stats.completed_count) if stats else (0, 0)
+
     candidates = []
     for player in players:
-        reward = get_player_expected_reward(order, player)
-        if reward is None:
-            continue
+        reward = _dispatch_reward(order, player, completed, price_map)
         profit = round(customer_price - reward, 2)
-        ongoing = Order.query.filter_by(player_id=player.id, status='进行中').count()
-        candidates.append((profit, -ongoing, player.id, reward))
-    if not candidates:
+        candidates.append((profit, -ongoing.get(player.id, 0), player.id, reward))
+    candidates.sort(key=lambda x: (x[0], x[1], standing(x[2])), reverse=True)
+    return candidates
+
+
+def _assign_order_to_player(order, player_id, reward):
+    """把订单分配给打手并写入顾客/打手通知（不提交事务）。
+    以条件更新（仍未分配且状态为待分配）写入，已被他人接走时返回 False 且不写通知。"""
+    updated = Order.query.filter(
+        Order.id == order.id,
+        Order.player_id.is_(None),
+        Order.status == '待分配'
+    ).update({'player_id': player_id, 'player_price': reward, 'status': '进行中'}, synchronize_session=False)
+    db.session.expire(order, ['player_id', 'player_price', 'status'])
+    if not updated:
         return False
-    # 按平台利润降序、进行中数量升序（-ongoing 降序即 ongoing 升序）
-    candidates.sort(key=lambda x: (x[0], x[1]), reverse=True)
-    best_player_id = candidates[0][2]
-    best_reward = candidates[0][3]
-    order.player_id = best_player_id
-    order.player_price = best_reward
-    order.status = '进行中'
+    apply_daily_stat_change(order_daily_stat(order, player_id=None, status='待分配'), order_daily_stat(order))
     if order.customer_id:
         notification = Notification(
             customer_id=order.customer_id,
@@ -270,12 +764,316 @@ def auto_assign_order(order_id):
         type='新订单',
         content=f'订单 {order.order_no} 已分配给您，请及时处理',
         receiver_type='player',
-        receiver_id=best_player_id
+        receiver_id=player_id
     ))
+    return True
+
+
+def auto_assign_order(order_id):
+    """自动分配订单：选择使平台利润（顾客价 - 打手报酬）最高的打手；同利润时优先分配给出勤更少的打手，
+    再相同时优先口碑更好（平均评分、累计完成数）的打手。
+    所有候选打手的进行中数量、本月完成数、个人报价与口碑计数各用一次查询取出，在内存中打分。"""
+    order = Order.query.get(order_id)
+    if not order or order.player_id is not None or order.status != '待分配':
+        return False
+    players = User.query.filter_by(role='player', is_approved=True).all()
+    if not players:
+        return False
+    customer_price = order.customer_price or 0
+    if customer_price <= 0:
+        return False
+    player_ids = [p.id for p in players]
+    tiered_ids = [p.id for p in players if p.income_mode == 'tiered']
+    candidates = _score_dispatch_candidates(
+        order, players,
+        _ongoing_counts(player_ids),
+        _monthly_completed_counts(tiered_ids),
+        _player_price_map(player_ids, [(order.game, order.task_type)]),
+        player_stats_map(player_ids)
+    )
+    if not candidates:
+        return False
+    best_player_id = candidates[0][2]
+    best_reward = candidates[0][3]
+    if not _assign_order_to_player(order, best_player_id, best_reward):
+        db.session.rollback()
+        return False
     db.session.commit()
     return True
 
 
+def _min_cost_assignment(cost):
+    """匈牙利算法（最短增广路版本），cost 为 n×m 整数矩阵且 n <= m。
+    返回长度为 n 的列表：第 i 行分配到的列号。"""
+    n = len(cost)
+    if n == 0:
+        return []
+    m = len(cost[0])
+    inf = float('inf')
+    u = [0] * (n + 1)
+    v = [0] * (m + 1)
+    p = [0] * (m + 1)
+    way = [0] * (m + 1)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = [inf] * (m + 1)
+        used = [False] * (m + 1)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            row = cost[i0 - 1]
+            ui0 = u[i0]
+            delta = inf
+            j1 = 0
+            for j in range(1, m + 1):
+                if not used[j]:
+                    cur = row[j - 1] - ui0 - v[j]
+                    if cur < minv[j]:
+                        minv[j] = cur
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+            for j in range(m + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while True:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+            if j0 == 0:
+                break
+    result = [0] * n
+    for j in range(1, m + 1):
+        if p[j]:
+            result[p[j] - 1] = j - 1
+    return result
+
+
+def batch_dispatch_orders():
+    """批量派单：把所有已支付的待分配订单与全部已审核打手一起求解，
+    在每位打手进行中订单不超过 DISPATCH_MAX_ONGOING 的前提下，先尽量多派单，再使平台总利润最高，
+    同利润时优先给进行中更少的打手。订单按下单时间每 DISPATCH_BATCH_CHUNK 单求解一次并提交，
+    下一段按最新的进行中数量求解。返回 (分配数, 待分配总数, 总利润)。
+    求解耗时随积压量增长，web 请求里只提交 DispatchBatch，由派单 worker 调用（或 flask dispatch-backlog）。"""
+    orders = Order.query.filter(
+        Order.status == '待分配',
+        Order.player_id.is_(None),
+        Order.payment_status == '已支付',
+        Order.customer_price > 0
+    ).order_by(Order.created_at).all()
+    players = User.query.filter_by(role='player', is_approved=True).all()
+    if not orders or not players:
+        return 0, len(orders), 0
+    player_ids = [p.id for p in players]
+    completed = _monthly_completed_counts([p.id for p in players if p.income_mode == 'tiered'])
+    price_map = _player_price_map(player_ids, [(o.game, o.task_type) for o in orders])
+    chunk = max(1, DISPATCH_BATCH_CHUNK)
+    assigned, total_profit = 0, 0
+    for start in range(0, len(orders), chunk):
+        chunk_assigned, chunk_profit = _batch_dispatch_chunk(orders[start:start + chunk], players, completed, price_map)
+        assigned += chunk_assigned
+        total_profit += chunk_profit
+    return assigned, len(orders), round(total_profit, 2)
+
+
+def _batch_dispatch_chunk(orders, players, completed, price_map):
+    """对一段订单求解一次全局指派并提交，返回 (分配数, 利润)。"""
+    ongoing = _ongoing_counts([p.id for p in players])
+    n = len(orders)
+    # 每位打手按剩余容量拆成若干“槽位”，第 k 个槽位的负载为 进行中数量 + k
+    slots = []
+    for player in players:
+        load = ongoing.get(player.id, 0)
+        free = min(max(0, DISPATCH_MAX_ONGOING - load), n)
+        for k in range(free):
+            slots.append((player, load + k))
+    if not slots:
+        return 0, 0
+    rewards = {}
+    profit_cents = {}
+    order_prices = [o.customer_price for o in orders]
+    for player in players:
+        computed = get_income_strategy(player).price_many(order_prices, completed.get(player.id, 0))
+        for i, order in enumerate(orders):
+            reward = computed[i]
+            if reward is None:
+                reward = price_map.get((player.id, order.game, order.task_type), 0)
+            rewards[(i, player.id)] = reward
+            profit_cents[(i, player.id)] = int(round((order.customer_price - reward) * 100))
+    # 整数代价，按优先级分层：派出的单数 > 平台利润 > 打手负载
+    load_weight = n * DISPATCH_MAX_ONGOING + 1
+    max_profit = max(abs(c) for c in profit_cents.values())
+    assign_bonus = 2 * (n + 1) * (max_profit + 1) * load_weight
+    cost = []
+    for i in range(n):
+        row = [load - profit_cents[(i, player.id)] * load_weight - assign_bonus for player, load in slots]
+        row.extend([0] * n)  # 不分配（虚拟列）
+        cost.append(row)
+    assigned, total_profit = 0, 0
+    for i, j in enumerate(_min_cost_assignment(cost)):
+        if j >= len(slots):
+            continue
+        order, player = orders[i], slots[j][0]
+        reward = rewards[(i, player.id)]
+        if not _assign_order_to_player(order, player.id, reward):
+            continue
+        assigned += 1
+        total_profit += order.customer_price - reward
+    db.session.commit()
+    return assigned, total_profit
+
+
+def _claim_dispatch_batch():
+    """认领最早一个待处理的批量派单请求（条件更新，多个 worker 只有一个拿到）；处理中超过 10 分钟视为 worker 已退出。"""
+    stale_before = datetime.utcnow() - timedelta(minutes=10)
+    claimable = db.or_(
+        DispatchBatch.status == 'pending',
+        db.and_(DispatchBatch.status == 'running', DispatchBatch.started_at < stale_before)
+    )
+    row = db.session.query(DispatchBatch.id).filter(claimable).order_by(DispatchBatch.id).first()
+    if row is None:
+        return None
+    updated = DispatchBatch.query.filter(DispatchBatch.id == row[0], claimable).update(
+        {'status': 'running', 'started_at': datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+    return row[0] if updated else None
+
+
+def process_dispatch_batches():
+    """执行一个批量派单请求，结果写回 DispatchBatch 并记操作日志。返回处理的请求数（0 或 1）。需在 app context 中调用。"""
+    batch_id = _claim_dispatch_batch()
+    if batch_id is None:
+        return 0
+    started = time.perf_counter()
+    try:
+        assigned, total, profit = batch_dispatch_orders()
+        error = None
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception('批量派单失败 batch=%s', batch_id)
+        assigned, total, profit, error = None, None, None, str(e)[:500]
+    batch = DispatchBatch.query.get(batch_id)
+    batch.status = 'failed' if error else 'done'
+    batch.total, batch.assigned, batch.profit, batch.error = total, assigned, profit, error
+    batch.duration_ms = round((time.perf_counter() - started) * 1000, 2)
+    batch.finished_at = datetime.utcnow()
+    db.session.add(Log(
+        user_id=batch.user_id,
+        action='batch_dispatch',
+        target_type='order',
+        detail=f'批量派单失败：{error}' if error else f'批量派单：待分配 {total} 单，已分配 {assigned} 单，平台利润 ￥{profit:.2f}'
+    ))
+    db.session.commit()
+    return 1
+
+
+# ---------- 派单队列 ----------
+_dispatch_wakeup = threading.Event()
+_dispatch_threads = []
+_dispatch_threads_lock = threading.Lock()
+
+
+def enqueue_dispatch(order_id):
+    """订单入派单队列（随调用方事务一起提交），提交后再调用 wake_dispatch_worker。"""
+    db.session.add(DispatchJob(order_id=order_id, status='pending'))
+
+
+def start_dispatch_workers():
+    """按 DISPATCH_WORKER_THREADS 启动进程内派单线程，已在运行则跳过。
+    fork 出的子进程（如 gunicorn --preload）里父进程的线程已不存在，按存活情况重新拉起。"""
+    if DISPATCH_WORKER_THREADS <= 0:
+        return
+    with _dispatch_threads_lock:
+        _dispatch_threads[:] = [t for t in _dispatch_threads if t.is_alive()]
+        if not _dispatch_threads:
+            for i in range(DISPATCH_WORKER_THREADS):
+                t = threading.Thread(target=run_dispatch_worker, name=f'dispatch-worker-{i}', daemon=True)
+                t.start()
+                _dispatch_threads.append(t)
+
+
+def wake_dispatch_worker():
+    """唤醒进程内派单 worker（线程未运行时先启动）。"""
+    if DISPATCH_WORKER_THREADS <= 0:
+        return
+    start_dispatch_workers()
+    _dispatch_wakeup.set()
+
+
+def _claim_dispatch_jobs(limit):
+    """认领一批待处理任务（条件更新，多线程/多进程并发时每个任务只会被一个 worker 拿到）。
+    处理中超过 10 分钟的任务视为 worker 已退出，重新认领。"""
+    stale_before = datetime.utcnow() - timedelta(minutes=10)
+    claimable = db.or_(
+        DispatchJob.status == 'pending',
+        db.and_(DispatchJob.status == 'running', DispatchJob.started_at < stale_before)
+    )
+    ids = [row[0] for row in db.session.query(DispatchJob.id).filter(claimable).order_by(DispatchJob.id).limit(limit).all()]
+    claimed = []
+    for job_id in ids:
+        updated = DispatchJob.query.filter(DispatchJob.id == job_id, claimable).update(
+            {'status': 'running', 'started_at': datetime.utcnow()}, synchronize_session=False)
+        if updated:
+            claimed.append(job_id)
+    db.session.commit()
+    return claimed
+
+
+def process_dispatch_jobs(limit=None):
+    """取一批派单任务逐个执行 auto_assign_order，记录耗时；遇到并发冲突回滚后重新入队，超过重试次数标记失败。
+    返回本批处理的任务数。需在 app context 中调用。"""
+    claimed = _claim_dispatch_jobs(limit or DISPATCH_BATCH_SIZE)
+    for job_id in claimed:
+        started = time.perf_counter()
+        assigned, error, retryable = None, None, False
+        try:
+            assigned = auto_assign_order(DispatchJob.query.get(job_id).order_id)
+        except (OperationalError, IntegrityError, StaleDataError) as e:
+            db.session.rollback()
+            error, retryable = str(e)[:500], True
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception('派单失败 job=%s', job_id)
+            error = str(e)[:500]
+        job = DispatchJob.query.get(job_id)
+        job.attempts = (job.attempts or 0) + 1
+        job.duration_ms = round((time.perf_counter() - started) * 1000, 2)
+        job.error = error
+        if error is None:
+            job.status = 'done'
+            job.assigned = assigned
+            job.finished_at = datetime.utcnow()
+        elif retryable and job.attempts < DISPATCH_MAX_ATTEMPTS:
+            job.status = 'pending'
+        else:
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+        db.session.commit()
+    return len(claimed)
+
+
+def run_dispatch_worker(stop_event=None):
+    """派单 worker 主循环：有任务就按批处理，队列空时等待唤醒或轮询间隔。"""
+    while not (stop_event and stop_event.is_set()):
+        try:
+            with app.app_context():
+                processed = process_dispatch_batches() + process_dispatch_jobs()
+        except Exception:
+            app.logger.exception('派单 worker 出错')
+            processed = 0
+        if not processed:
+            _dispatch_wakeup.wait(DISPATCH_POLL_SECONDS)
+            _dispatch_wakeup.clear()
+
+
 def get_player_price(player_id, game, task_type, default_price):
     """获取打手对该任务的实际报价，如果没有则返回默认价格"""
     player_price = PlayerPrice.query.filter_by(
@@ -301,6 +1099,93 @@ def get_player_expected_reward(order, player):
     return get_player_price(player.id, order.game, order.task_type, 0)
 
 
+def get_player_expected_rewards(orders, player):
+    """批量版 get_player_expected_reward：打手报价一次查出，按收益规则整批计价，返回与 orders 等长的列表。"""
+    if not orders or not player:
+        return [None] * len(orders or [])
+    strategy = get_income_strategy(player)
+    completed = 0
+    if strategy.mode == 'tiered':
+        completed = _monthly_completed_counts([player.id]).get(player.id, 0)
+    prices = [o.customer_price or 0 for o in orders]
+    computed = strategy.price_many(prices, completed)
+    price_map = {}
+    if any(r is None for r in computed):
+        price_map = _player_price_map([player.id], [(o.game, o.task_type) for o in orders])
+    rewards = []
+    for order, price, reward in zip(orders, prices, computed):
+        if price <= 0:
+            rewards.append(0)
+        elif reward is not None:
+            rewards.append(reward)
+        else:
+            rewards.append(price_map.get((player.id, order.game, order.task_type), 0))
+    return rewards
+
+
+def parse_preferred_games(preferred_games):
+    """把 preferred_games（逗号分隔，兼容中文逗号）拆为去重后的游戏列表，保持原顺序。
+    超过 PlayerGame.game 列宽的条目跳过：游戏名最长 50 字，这样的条目本就匹配不到任何意向，
+    写入反而会在 PostgreSQL 上报错并连带资料保存/启动回填失败。"""
+    max_len = PlayerGame.game.type.length
+    games = []
+    for g in (preferred_games or '').replace('，', ',').split(','):
+        g = g.strip()
+        if g and len(g) <= max_len and g not in games:
+            games.append(g)
+    return games
+
+
+def sync_player_games(player):
+    """按 player.preferred_games 重写该打手的 PlayerGame 行（随调用方一起提交）"""
+    PlayerGame.query.filter_by(player_id=player.id).delete(synchronize_session=False)
+    for game in parse_preferred_games(player.preferred_games):
+        db.session.add(PlayerGame(player_id=player.id, game=game))
+
+
+def rebuild_player_games():
+    """按 User.preferred_games 全量重建 PlayerGame 表，返回写入行数"""
+    PlayerGame.query.delete(synchronize_session=False)
+    count = 0
+    players = User.query.filter(User.role == 'player', User.preferred_games.isnot(None))
+    for player_id, preferred_games in players.with_entities(User.id, User.preferred_games):
+        for game in parse_preferred_games(preferred_games):
+            db.session.add(PlayerGame(player_id=player_id, game=game))
+            count += 1
+    db.session.commit()
+    return count
+
+
+def visible_custom_requests_query(player):
+    """打手可见的待接单意向：普通意向全部可见，二次元/无平台价意向仅擅长该游戏的打手可见"""
+    player_games = db.session.query(PlayerGame.game).filter(PlayerGame.player_id == player.id)
+    return CustomOfferRequest.query.filter(
+        CustomOfferRequest.status == '待接单',
+        db.or_(
+            CustomOfferRequest.is_anime_no_display == False,
+            CustomOfferRequest.is_anime_no_display.is_(None),
+            CustomOfferRequest.game.in_(player_games),
+        )
+    )
+
+
+def notify_players_for_anime_request(req):
+    """二次元/无平台价意向发布后，仅通知擅长该游戏且已审核的打手（随调用方一起提交）"""
+    player_ids = db.session.query(PlayerGame.player_id).join(User, User.id == PlayerGame.player_id).filter(
+        PlayerGame.game == req.game,
+        User.role == 'player',
+        User.is_approved == True
+    ).all()
+    for (player_id,) in player_ids:
+        db.session.add(Notification(
+            type='新意向',
+            content=f'有顾客发布了 {req.game} 的报价意向 {req.request_no}（{req.task_type}，报价 {req.offered_price} 元），可前往可接订单查看。',
+            receiver_type='player',
+            receiver_id=player_id
+        ))
+    return len(player_ids)
+
+
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
@@ -323,6 +1208,7 @@ def on_order_completed(order):
             existing.price = platform_price
         else:
             db.session.add(Price(game=req.game, task_type=req.task_type, price=platform_price))
+        bump_price_catalog_version()
 
 
 # ---------- 打手管理 ----------
@@ -339,6 +1225,10 @@ def remove_player(player_id):
     
     player_name = player.player_name or player.username
     Order.query.filter_by(player_id=player.id).update({'player_id': None})
+    PlayerMonthlyCompletion.query.filter_by(player_id=player.id).delete()
+    move_daily_stats_to_unassigned(player.id)
+    PlayerStats.query.filter_by(player_id=player.id).delete()
+    PlayerGame.query.filter_by(player_id=player.id).delete()
     db.session.delete(player)
     log = Log(
         user_id=current_user.id,
@@ -358,7 +1248,12 @@ def admin_players():
     if current_user.role != 'admin':
         return redirect(url_for('player_dashboard'))
     players = User.query.filter_by(role='player').order_by(User.registered_at.desc()).all()
-    return render_template('admin_players.html', players=players)
+    player_ids = [p.id for p in players]
+    order_counts = dict(db.session.query(Order.player_id, func.count(Order.id)).filter(
+        Order.player_id.in_(player_ids)
+    ).group_by(Order.player_id).all()) if player_ids else {}
+    return render_template('admin_players.html', players=players, order_counts=order_counts,
+                           player_stats=player_stats_map(player_ids))
 
 @app.route('/admin/player/edit/<int:player_id>', methods=['GET', 'POST'])
 @login_required
@@ -376,6 +1271,7 @@ def admin_edit_player(player_id):
         player.wechat = form.wechat.data
         player.income_mode = form.income_mode.data
         player.tiered_rates = form.tiered_rates.data or None
+        bump_income_version(player)
         player.allow_custom_price = form.allow_custom_price.data
         player.is_certified = form.is_certified.data
         db.session.commit()
@@ -446,6 +1342,7 @@ def choose_income_mode():
                 current_user.tiered_rates = json.dumps({'rate': 80})
         else:
             current_user.tiered_rates = None
+        bump_income_version(current_user)
         db.session.commit()
         flash('收益模式设置成功！')
         return redirect(url_for('player_dashboard'))
@@ -522,6 +1419,31 @@ def logout():
     return redirect(url_for('login'))
 
 # ---------- 管理员仪表盘 ----------
+def day_range(day):
+    """某天的半开区间 [当天 0 点, 次日 0 点)。按天过滤写成 created_at 的范围条件才能走索引，
+    不要写 func.date(created_at) == day。"""
+    start = datetime.combine(day, datetime.min.time())
+    return start, start + timedelta(days=1)
+
+
+def parse_day(value):
+    """'YYYY-MM-DD' → date，为空或格式不对时返回 None。"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+    except ValueError:
+        return None
+
+
+def filter_created_range(query, args):
+    """按 ?start=&end=（YYYY-MM-DD，含首尾两天）限定下单时间，未给出的一端不限。"""
+    start, end = parse_day(args.get('start', '')), parse_day(args.get('end', ''))
+    if start:
+        query = query.filter(Order.created_at >= day_range(start)[0])
+    if end:
+        query = query.filter(Order.created_at < day_range(end)[1])
+    return query
+
+
 @app.route('/admin')
 @login_required
 def admin_dashboard():
@@ -529,37 +1451,59 @@ def admin_dashboard():
         return redirect(url_for('player_dashboard'))
 
     today = datetime.utcnow().date()
-    month_start = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
 
-    today_total = Order.query.filter(func.date(Order.created_at) == today).count()
-    today_completed = Order.query.filter(
-        func.date(Order.created_at) == today,
-        Order.status == '已完成'
-    ).count()
-    pending_orders = Order.query.filter(
+    # 今日卡片与本月排行读按天汇总表 DailyStat，不扫订单表
+    today_total, today_completed, today_revenue = db.session.query(
+        func.coalesce(func.sum(DailyStat.order_count), 0),
+        func.coalesce(func.sum(DailyStat.completed_count), 0),
+        func.coalesce(func.sum(DailyStat.customer_revenue), 0)
+    ).filter(DailyStat.day == today).one()
+    pending_count = Order.query.filter(
         Order.status.in_(['待分配', '进行中', '待验收'])
-    ).order_by(Order.created_at.desc()).all()
-    today_revenue = db.session.query(
-        func.coalesce(func.sum(Order.customer_price), 0)
-    ).filter(
-        func.date(Order.created_at) == today,
-        Order.status == '已完成'
-    ).scalar() or 0
+    ).count()
+    month_completed = func.sum(DailyStat.completed_count)
     player_ranking = db.session.query(
         User.id, User.player_name, User.username,
-        func.count(Order.id).label('completed_count')
-    ).join(Order, Order.player_id == User.id).filter(
-        Order.status == '已完成',
-        Order.created_at >= month_start
-    ).group_by(User.id).order_by(func.count(Order.id).desc()).limit(5).all()
-    
-    order_no = request.args.get('order_no', '')
-    game = request.args.get('game', '')
-    task_type = request.args.get('task_type', '')
-    player_id = request.args.get('player_id', type=int)
-    status = request.args.get('status', '')
-    
-    query = Order.query
+        month_completed.label('completed_count')
+    ).join(DailyStat, DailyStat.player_id == User.id).filter(
+        DailyStat.day >= today.replace(day=1)
+    ).group_by(User.id).having(month_completed > 0).order_by(month_completed.desc()).limit(5).all()
+
+    # 订单列表由页面通过 admin_orders_api 按游标分批加载，这里只给筛选下拉框用的打手名单
+    players = db.session.query(User.id, User.player_name).filter(User.role == 'player').order_by(User.id).all()
+    return render_template('admin_dashboard.html',
+        players=players,
+        today_total=today_total, today_completed=today_completed,
+        pending_count=pending_count, today_revenue=float(today_revenue),
+        player_ranking=player_ranking,
+        page_size=ADMIN_ORDER_PAGE_SIZE,
+        order_filters=admin_order_filter_args(request.args),
+        last_batch=DispatchBatch.query.order_by(DispatchBatch.id.desc()).first()
+    )
+
+
+# ---------- 管理员订单列表（键集分页）----------
+# 按 (created_at, id) 倒序翻页：游标记住上一页最后一单，下一页从索引上的该位置继续往后取，
+# 每页耗时与历史订单总数无关（OFFSET 翻页越往后越慢）。
+ADMIN_ORDER_PAGE_SIZE = 50
+ADMIN_ORDER_MAX_PAGE_SIZE = 200
+
+
+ADMIN_ORDER_FILTER_KEYS = ('order_no', 'game', 'task_type', 'player_id', 'status', 'start', 'end')
+
+
+def admin_order_filter_args(args):
+    """从查询参数中取出非空的筛选条件，供页面拼接口/导出链接；format、endpoint 等其他参数不带入 url_for。"""
+    return {k: args[k] for k in ADMIN_ORDER_FILTER_KEYS if args.get(k)}
+
+
+def filter_admin_orders(query, args):
+    """按管理员面板的筛选条件（order_no / game / task_type / player_id / status / start / end）过滤订单查询。"""
+    order_no = args.get('order_no', '')
+    game = args.get('game', '')
+    task_type = args.get('task_type', '')
+    player_id = args.get('player_id', type=int)
+    status = args.get('status', '')
     if order_no:
         query = query.filter(Order.order_no.contains(order_no))
     if game:
@@ -570,15 +1514,164 @@ def admin_dashboard():
         query = query.filter(Order.player_id == player_id)
     if status:
         query = query.filter(Order.status == status)
-    
-    orders = query.order_by(Order.created_at.desc()).all()
-    players = User.query.filter_by(role='player').all()
-    return render_template('admin_dashboard.html',
-        orders=orders, players=players,
-        today_total=today_total, today_completed=today_completed,
-        pending_orders=pending_orders, today_revenue=float(today_revenue),
-        player_ranking=player_ranking
-    )
+    return filter_created_range(query, args)
+
+
+def encode_order_cursor(created_at, order_id):
+    raw = f'{created_at.isoformat()}|{order_id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_order_cursor(cursor):
+    """游标 -> (created_at, id)，格式不对返回 None。"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, order_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(order_id)
+    except ValueError:
+        return None
+
+
+def admin_orders_page(args, cursor=None, limit=ADMIN_ORDER_PAGE_SIZE):
+    """按筛选条件取游标之后的一页订单，返回 ([(order, 打手名), ...], 下一页游标或 None)。"""
+    query = filter_admin_orders(
+        db.session.query(Order, User.player_name).outerjoin(User, Order.player_id == User.id), args)
+    if cursor:
+        # 即 (created_at, id) < 游标；先写出 created_at <= 游标时间，索引才能直接定位到范围起点
+        created_at, order_id = cursor
+        query = query.filter(
+            Order.created_at <= created_at,
+            db.or_(Order.created_at < created_at, Order.id < order_id)
+        )
+    rows = query.order_by(Order.created_at.desc(), Order.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1][0]
+        if last.created_at:
+            next_cursor = encode_order_cursor(last.created_at, last.id)
+    return rows, next_cursor
+
+
+@app.route('/admin/api/orders')
+@login_required
+def admin_orders_api():
+    """管理员订单列表 JSON：?cursor=&limit=&order_no=&game=&task_type=&player_id=&status=&start=&end="""
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'error': '无权操作'}), 403
+    cursor = None
+    if request.args.get('cursor'):
+        cursor = decode_order_cursor(request.args['cursor'])
+        if cursor is None:
+            return jsonify({'success': False, 'error': '游标无效'}), 400
+    limit = max(1, min(request.args.get('limit', ADMIN_ORDER_PAGE_SIZE, type=int), ADMIN_ORDER_MAX_PAGE_SIZE))
+    rows, next_cursor = admin_orders_page(request.args, cursor, limit)
+    return jsonify({
+        'success': True,
+        'orders': [{
+            'id': o.id,
+            'order_no': o.order_no,
+            'game': o.game,
+            'task_type': o.task_type,
+            'customer_price': o.customer_price,
+            'player_price': o.player_price,
+            'player_name': (player_name or '') if o.player_id else None,
+            'status': o.status,
+            'is_custom_offer': bool(o.is_custom_offer),
+            'screenshot_url': url_for('static', filename='uploads/' + o.screenshot) if o.screenshot else None,
+            'notes': o.notes,
+            'created_at': o.created_at.strftime('%Y-%m-%d %H:%M') if o.created_at else None,
+        } for o, player_name in rows],
+        'next_cursor': next_cursor,
+    })
+
+
+# ---------- 流式导出（CSV / NDJSON）----------
+# 按 yield_per 从数据库游标分批取行（PostgreSQL 下为服务端游标），边取边写给客户端，
+# 内存占用与导出行数无关，导出一整年的订单也不会超时或占满 worker 内存。
+EXPORT_FORMATS = {'csv': 'text/csv; charset=utf-8', 'ndjson': 'application/x-ndjson; charset=utf-8'}
+EXPORT_CHUNK_CHARS = 64 * 1024
+
+ADMIN_ORDER_EXPORT_COLUMNS = [
+    ('order_no', '订单号'), ('game', '游戏'), ('service_type', '服务类型'), ('task_type', '任务类型'),
+    ('customer_price', '顾客价'), ('player_price', '打手价'), ('player_name', '打手'),
+    ('status', '状态'), ('payment_status', '支付状态'), ('created_at', '下单时间'),
+]
+PLAYER_INCOME_EXPORT_COLUMNS = [
+    ('order_no', '订单号'), ('game', '游戏'), ('task_type', '任务类型'), ('income', '收入'), ('created_at', '完成时间'),
+]
+
+
+def _csv_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return '%.2f' % value
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M')
+    return value
+
+
+def _json_value(value):
+    if isinstance(value, float):
+        return round(value, 2)
+    if isinstance(value, datetime):
+        return value.isoformat(timespec='seconds')
+    return value
+
+
+def stream_export(query, columns, fmt, filename):
+    """把按列查询 query 的结果流式导出。columns 为 [(字段名, 表头), ...]，与查询列一一对应；
+    fmt 为 csv（带 UTF-8 BOM，Excel 直接打开不乱码）或 ndjson（每行一个以字段名为键的 JSON 对象）。"""
+    keys = [key for key, _ in columns]
+
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        if fmt == 'csv':
+            buf.write('\ufeff')
+            writer.writerow([title for _, title in columns])
+        for row in query.yield_per(EXPORT_YIELD_PER):
+            if fmt == 'csv':
+                writer.writerow([_csv_cell(value) for value in row])
+            else:
+                buf.write(json.dumps(dict(zip(keys, map(_json_value, row))), ensure_ascii=False) + '\n')
+            if buf.tell() >= EXPORT_CHUNK_CHARS:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+
+    response = app.response_class(stream_with_context(generate()), content_type=EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = 'attachment; filename=%s.%s' % (filename, fmt)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@app.route('/admin/orders/export')
+@login_required
+def admin_orders_export():
+    """按管理员面板的筛选条件与下单日期范围导出订单：?format=csv|ndjson&order_no=&game=&task_type=&player_id=&status=&start=&end="""
+    if current_user.role != 'admin':
+        return redirect(url_for('player_dashboard'))
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        flash('不支持的导出格式')
+        return redirect(url_for('admin_dashboard'))
+    query = filter_admin_orders(db.session.query(
+        Order.order_no, Order.game, Order.service_type, Order.task_type,
+        db.cast(Order.customer_price, db.Float), db.cast(Order.player_price, db.Float), User.player_name, Order.status, Order.payment_status, Order.created_at
+    ).outerjoin(User, Order.player_id == User.id), request.args)
+    filters = admin_order_filter_args(request.args)
+    db.session.add(Log(
+        user_id=current_user.id,
+        action='export_orders',
+        target_type='order',
+        detail=f'导出订单（{fmt}），筛选条件：{json.dumps(filters, ensure_ascii=False) if filters else "全部"}'
+    ))
+    db.session.commit()
+    return stream_export(query.order_by(Order.created_at.desc(), Order.id.desc()), ADMIN_ORDER_EXPORT_COLUMNS, fmt,
+                         'orders_%s' % datetime.utcnow().strftime('%Y%m%d'))
 
 @app.route('/add_order', methods=['GET', 'POST'])
 @login_required
@@ -611,6 +1704,7 @@ def add_order():
                 order.player_price = computed
         db.session.add(order)
         db.session.flush()
+        apply_daily_stat_change(None, order_daily_stat(order))
         if order.player_id:
             notification = Notification(
                 order_id=order.id,
@@ -620,8 +1714,9 @@ def add_order():
                 receiver_id=order.player_id
             )
             db.session.add(notification)
+        enqueue_dispatch(order.id)
         db.session.commit()
-        auto_assign_order(order.id)
+        wake_dispatch_worker()
         flash('订单添加成功')
         return redirect(url_for('admin_dashboard'))
     return render_template('add_order.html', form=form)
@@ -636,7 +1731,10 @@ def edit_order(order_id):
         old_status = order.status
         new_status = request.form['status']
         if old_status != new_status:
-            order.status = new_status
+            if not change_order_status(order, old_status, new_status):
+                db.session.rollback()
+                flash('订单状态已被其他操作修改，请刷新后重试')
+                return redirect(url_for('edit_order', order_id=order.id))
             if order.customer_id:
                 notification = Notification(
                     customer_id=order.customer_id,
@@ -663,6 +1761,22 @@ def edit_order(order_id):
         return redirect(url_for('admin_dashboard'))
     return render_template('admin/edit_order.html', order=order)
 
+
+@app.route('/admin/dispatch/batch', methods=['POST'])
+@login_required
+def admin_batch_dispatch():
+    """管理员：提交一次全局批量派单，由派单 worker 在后台求解，结果见面板与操作日志。"""
+    if current_user.role != 'admin':
+        return redirect(url_for('player_dashboard'))
+    if DispatchBatch.query.filter(DispatchBatch.status.in_(['pending', 'running'])).first():
+        flash('已有批量派单在后台处理中，请稍后刷新查看结果')
+        return redirect(url_for('admin_dashboard'))
+    db.session.add(DispatchBatch(user_id=current_user.id, status='pending'))
+    db.session.commit()
+    wake_dispatch_worker()
+    flash('已提交批量派单，后台处理完成后刷新面板查看结果')
+    return redirect(url_for('admin_dashboard'))
+
 # ---------- 打手面板 ----------
 @app.route('/player')
 @login_required
@@ -671,24 +1785,24 @@ def player_dashboard():
         return redirect(url_for('admin_dashboard'))
     orders = Order.query.filter_by(player_id=current_user.id).order_by(Order.created_at.desc()).all()
 
-    # 过去30天每日收入（按订单完成时间分组，已完成订单）
-    start_date = datetime.utcnow() - timedelta(days=30)
+    # 过去30天每日收入（已完成订单的打手报酬，按下单日期），读按天汇总表 DailyStat
+    today = datetime.utcnow().date()
+    start_day = today - timedelta(days=29)
     daily_income = db.session.query(
-        func.date(Order.created_at).label('date'),
-        func.sum(Order.player_price).label('total')
+        DailyStat.day,
+        func.sum(DailyStat.player_payout).label('total')
     ).filter(
-        Order.player_id == current_user.id,
-        Order.status == '已完成',
-        Order.created_at >= start_date
-    ).group_by(func.date(Order.created_at)).all()
+        DailyStat.player_id == current_user.id,
+        DailyStat.day >= start_day
+    ).group_by(DailyStat.day).all()
 
-    income_map = {str(row.date): float(row.total or 0) for row in daily_income}
+    income_map = {row.day: float(row.total or 0) for row in daily_income}
     chart_labels = []
     chart_data = []
     for i in range(29, -1, -1):
-        d = (datetime.utcnow() - timedelta(days=i)).date()
+        d = today - timedelta(days=i)
         chart_labels.append(d.strftime('%m-%d'))
-        chart_data.append(income_map.get(str(d), 0))
+        chart_data.append(round(income_map.get(d, 0), 2))
 
     return render_template('player_dashboard.html', orders=orders, chart_labels=chart_labels, chart_data=chart_data)
 
@@ -696,7 +1810,7 @@ def player_dashboard():
 @app.route('/player/income')
 @login_required
 def player_income():
-    """打手收入统计：按日/周/月筛选，支持导出 CSV"""
+    """打手收入统计：按日/周/月筛选；?export=csv|ndjson 流式导出，可用 start/end（YYYY-MM-DD）指定任意日期范围"""
     if current_user.role != 'player':
         return redirect(url_for('player_dashboard'))
     period = request.args.get('period', 'month')  # day, week, month
@@ -707,31 +1821,27 @@ def player_income():
         start = now - timedelta(days=7)
     else:
         start = now - timedelta(days=30)
+    export = request.args.get('export')
+    if export in EXPORT_FORMATS:
+        query = db.session.query(
+            Order.order_no, Order.game, Order.task_type, db.cast(func.coalesce(Order.player_price, 0), db.Float),
+            Order.created_at
+        ).filter(
+            Order.player_id == current_user.id,
+            Order.status == '已完成'
+        )
+        if request.args.get('start') or request.args.get('end'):
+            query = filter_created_range(query, request.args)
+        else:
+            query = query.filter(Order.created_at >= start)
+        return stream_export(query.order_by(Order.created_at.desc()), PLAYER_INCOME_EXPORT_COLUMNS, export,
+                             'income_%s' % now.strftime('%Y%m%d'))
     orders = Order.query.filter(
         Order.player_id == current_user.id,
         Order.status == '已完成',
         Order.created_at >= start
     ).order_by(Order.created_at.desc()).all()
     total_income = sum((o.player_price or 0) for o in orders)
-    if request.args.get('export') == 'csv':
-        from flask import make_response
-        import csv
-        import io
-        buf = io.StringIO()
-        w = csv.writer(buf)
-        w.writerow(['订单号', '游戏', '任务类型', '收入', '完成时间'])
-        for o in orders:
-            w.writerow([
-                o.order_no or '',
-                o.game or '',
-                o.task_type or '',
-                '%.2f' % (o.player_price or 0),
-                (o.created_at.strftime('%Y-%m-%d %H:%M') if o.created_at else '')
-            ])
-        resp = make_response(buf.getvalue())
-        resp.headers['Content-Type'] = 'text/csv; charset=utf-8-sig'
-        resp.headers['Content-Disposition'] = 'attachment; filename=income_%s.csv' % now.strftime('%Y%m%d')
-        return resp
     return render_template('player/income.html', orders=orders, total_income=total_income, period=period)
 
 
@@ -744,26 +1854,21 @@ def player_pending_orders():
     if not current_user.is_approved:
         flash('您的账号尚未通过审核，无法接单')
         return redirect(url_for('player_dashboard'))
-    # 仅已支付的待分配订单（顾客未支付的不作数、不展示）
-    orders = Order.query.filter(
+    # 仅已支付的待分配订单（顾客未支付的不作数、不展示），分页展示
+    page = request.args.get('page', 1, type=int)
+    per_page = 20
+    pagination = Order.query.filter(
         Order.status == '待分配',
         Order.player_id.is_(None),
         Order.payment_status == '已支付'
-    ).order_by(Order.created_at.desc()).all()
-    # 为每条普通订单计算当前打手接单的预计报酬（报价）
-    orders_with_reward = [(o, get_player_expected_reward(o, current_user)) for o in orders]
+    ).order_by(Order.created_at.desc(), Order.id.desc()).paginate(page=page, per_page=per_page)
+    orders = pagination.items
+    # 为当前页订单整批计算打手接单的预计报酬（报价）
+    orders_with_reward = list(zip(orders, get_player_expected_rewards(orders, current_user)))
     # 顾客报价意向：接单后顾客再支付，支付成功才生成订单（另一种模式）
-    all_requests = CustomOfferRequest.query.filter_by(status='待接单').order_by(CustomOfferRequest.created_at.desc()).all()
-    # 二次元/无平台价意向：仅推送给擅长该游戏的打手
-    def _player_can_see_request(req, player):
-        if not getattr(req, 'is_anime_no_display', False):
-            return True
-        if not player or not player.preferred_games:
-            return False
-        preferred = [x.strip() for x in (player.preferred_games or '').split(',') if x.strip()]
-        return (req.game or '').strip() in preferred
-    requests = [r for r in all_requests if _player_can_see_request(r, current_user)]
-    return render_template('player/pending_orders.html', orders_with_reward=orders_with_reward, requests=requests)
+    # 二次元/无平台价意向：仅推送给擅长该游戏的打手（按 PlayerGame 在 SQL 中过滤）
+    requests = visible_custom_requests_query(current_user).order_by(CustomOfferRequest.created_at.desc()).all()
+    return render_template('player/pending_orders.html', orders_with_reward=orders_with_reward, requests=requests, pagination=pagination)
 
 
 @app.route('/player/claim_order/<int:order_id>', methods=['POST'])
@@ -776,13 +1881,19 @@ def player_claim_order(order_id):
         flash('您的账号尚未通过审核，无法接单')
         return redirect(url_for('player_pending_orders'))
     order = Order.query.get_or_404(order_id)
-    if order.status != '待分配' or order.player_id is not None:
+    reward = calculate_player_price(order.customer_price or 0, current_user)
+    # 条件更新认领：多名打手同时接单时只有一人成功，无需行锁
+    claimed = Order.query.filter(
+        Order.id == order.id,
+        Order.player_id.is_(None),
+        Order.status == '待分配'
+    ).update({'player_id': current_user.id, 'player_price': reward if reward is not None else 0}, synchronize_session=False)
+    db.session.expire(order, ['player_id', 'player_price'])
+    if not claimed:
+        db.session.rollback()
         flash('该订单已被接单或状态已变更')
         return redirect(url_for('player_pending_orders'))
-    order.player_id = current_user.id
-    reward = calculate_player_price(order.customer_price or 0, current_user)
-    order.player_price = reward if reward is not None else 0
-    db.session.commit()
+    apply_daily_stat_change(order_daily_stat(order, player_id=None), order_daily_stat(order))
     if order.customer_id:
         notification = Notification(
             customer_id=order.customer_id,
@@ -793,7 +1904,7 @@ def player_claim_order(order_id):
             receiver_id=order.customer_id
         )
         db.session.add(notification)
-        db.session.commit()
+    db.session.commit()
     flash(f'已接单：{order.order_no}')
     return redirect(url_for('player_dashboard'))
 
@@ -808,12 +1919,15 @@ def player_claim_custom_request(request_id):
         flash('您的账号尚未通过审核，无法接单')
         return redirect(url_for('player_pending_orders'))
     req = CustomOfferRequest.query.get_or_404(request_id)
-    if req.status != '待接单':
+    claimed = CustomOfferRequest.query.filter(
+        CustomOfferRequest.id == req.id,
+        CustomOfferRequest.player_id.is_(None),
+        CustomOfferRequest.status == '待接单'
+    ).update({'player_id': current_user.id, 'status': '已接单'}, synchronize_session=False)
+    if not claimed:
+        db.session.rollback()
         flash('该意向已被接单或已支付')
         return redirect(url_for('player_pending_orders'))
-    req.player_id = current_user.id
-    req.status = '已接单'
-    db.session.commit()
     if req.customer_id:
         db.session.add(Notification(
             customer_id=req.customer_id,
@@ -822,7 +1936,7 @@ def player_claim_custom_request(request_id):
             receiver_type='customer',
             receiver_id=req.customer_id
         ))
-        db.session.commit()
+    db.session.commit()
     flash(f'已接单意向：{req.request_no}，等待顾客支付')
     return redirect(url_for('player_dashboard'))
 
@@ -949,8 +2063,9 @@ def _apply_parsed_rows_to_player_quotes(rows):
     if not rows:
         return 0, 0
     matched = 0
+    catalog = get_price_catalog()
     for game, task_type, price, _ in rows:
-        platform_price = _find_platform_price_fuzzy(game, task_type)
+        platform_price = _find_platform_price_fuzzy(game, task_type, catalog=catalog)
         if not platform_price:
             continue
         use_game = platform_price.game
@@ -991,27 +2106,7 @@ def player_price_import_image():
         if ext not in SITE_IMAGE_EXT:
             flash('请上传图片（jpg/png/gif/webp）')
             return redirect(url_for('player_price_import_image'))
-        import tempfile
-        path = os.path.join(tempfile.gettempdir(), f"player_img_{current_user.id}_{int(datetime.utcnow().timestamp())}{ext}")
-        f.save(path)
-        try:
-            rows, err = _parse_image_prices(path)
-            if err:
-                flash('识别失败：' + err)
-                return redirect(url_for('player_price_import_image'))
-            if not rows:
-                flash('未能识别出有效价格行，请确保图片清晰且包含任务与价格')
-                return redirect(url_for('player_price_import_image'))
-            matched, total = _apply_parsed_rows_to_player_quotes(rows)
-            db.session.commit()
-            flash(f'图片识别完成：共 {total} 条，其中 {matched} 条与平台任务匹配，已填入您的报价')
-        finally:
-            if os.path.exists(path):
-                try:
-                    os.remove(path)
-                except OSError:
-                    pass
-        return redirect(url_for('player_my_prices'))
+        return _start_import_job(f, 'image', 'player')
     return redirect(url_for('player_price_import'))
 
 
@@ -1031,27 +2126,7 @@ def player_price_import_pdf():
         if not f.filename or not f.filename.lower().endswith('.pdf'):
             flash('请上传 PDF 文件')
             return redirect(url_for('player_price_import_pdf'))
-        import tempfile
-        path = os.path.join(tempfile.gettempdir(), secure_filename(f.filename) or 'upload.pdf')
-        f.save(path)
-        try:
-            rows, err = _parse_pdf_prices(path)
-            if err:
-                flash('解析失败：' + err)
-                return redirect(url_for('player_price_import_pdf'))
-            if not rows:
-                flash('未能从 PDF 解析出有效价格行')
-                return redirect(url_for('player_price_import_pdf'))
-            matched, total = _apply_parsed_rows_to_player_quotes(rows)
-            db.session.commit()
-            flash(f'PDF 解析完成：共 {total} 条，其中 {matched} 条与平台任务匹配，已填入您的报价')
-        finally:
-            if os.path.exists(path):
-                try:
-                    os.remove(path)
-                except OSError:
-                    pass
-        return redirect(url_for('player_my_prices'))
+        return _start_import_job(f, 'pdf', 'player')
     return redirect(url_for('player_price_import'))
 
 
@@ -1061,7 +2136,7 @@ def player_price_import():
     """打手：识别填入报价入口页（图片 / PDF 上传）。"""
     if current_user.role != 'player':
         return redirect(url_for('index'))
-    return render_template('player/price_import_recognize.html')
+    return render_template('player/price_import_recognize.html', cache_stats=parse_cache_stats())
 
 
 @app.route('/update_status/<int:order_id>/<string:status>')
@@ -1074,7 +2149,10 @@ def update_status(order_id, status):
         return redirect(url_for('player_dashboard'))
     old_status = order.status
     if status in ['进行中', '待验收', '已完成']:
-        order.status = status
+        if not change_order_status(order, old_status, status):
+            db.session.rollback()
+            flash('订单状态已被其他操作修改，请刷新后重试')
+            return redirect(request.referrer)
         if old_status != status:
             if order.customer_id:
                 notification = Notification(
@@ -1119,8 +2197,10 @@ def upload_screenshot(order_id):
         filename = secure_filename(f"{order.order_no}_{file.filename}")
         file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
         old_status = order.status
-        order.screenshot = filename
-        order.status = '待验收'
+        if not change_order_status(order, old_status, '待验收', screenshot=filename):
+            db.session.rollback()
+            flash('订单状态已被其他操作修改，请刷新后重试')
+            return redirect(url_for('player_dashboard'))
         if order.customer_id and old_status != '待验收':
             notification = Notification(
                 customer_id=order.customer_id,
@@ -1156,6 +2236,7 @@ def player_profile():
         current_user.phone = phone.strip() or None
         current_user.wechat = wechat.strip() or None
         current_user.preferred_games = preferred_games.strip() or None
+        sync_player_games(current_user)
         current_user.income_mode = income_mode
 
         # 打手展示：直播间链接、设备描述
@@ -1203,6 +2284,7 @@ def player_profile():
             current_user.tiered_rates = tiered_rates_raw.strip() or None
         else:
             current_user.tiered_rates = None
+        bump_income_version(current_user)
 
         db.session.commit()
         flash('资料更新成功')
@@ -1639,9 +2721,7 @@ def member_pay_confirm(order_id):
 
 @app.route('/customer')
 def customer_index():
-    prices = Price.query.filter(
-        db.or_(Price.service_type == '代肝', Price.service_type.is_(None))
-    ).order_by(Price.game, Price.task_type).all()
+    prices = get_price_catalog().prices('代肝')
     grouped_prices = {}
     phone = request.args.get('phone', '')
     customer = None
@@ -1669,52 +2749,102 @@ def customer_index():
                           customer=customer, customer_level=customer_level, membership=membership, phone=phone,
                           price_table_images=list_price_table_images())
 
-@app.route('/hot-players')
-def hot_players():
-    players_raw = User.query.filter_by(role='player', is_approved=True).order_by(User.player_name).all()
+# ---------- 热门打手 ----------
+# 热门打手页是公开页面，推广时访问量集中。排行用一次分组查询算出，每个 worker 进程缓存一份快照：
+# 评价或订单完成/撤销完成时递增 SiteCounter('hot_players') 版本号，各 worker 下一次请求即重建；
+# 另外快照最长保留 HOT_PLAYERS_TTL 秒，打手资料、审核状态等改动随定时重建带上。
+HOT_PLAYERS_COUNTER = 'hot_players'
+
+HotPlayer = namedtuple('HotPlayer', ['id', 'username', 'player_name', 'is_certified', 'live_room_url',
+                                     'equipment_desc', 'preferred_games'])
+HotPlayersSnapshot = namedtuple('HotPlayersSnapshot', ['version', 'built_at', 'players', 'etag'])
+
+_hot_players_snapshot = None
+
+
+def hot_players_version():
+    return db.session.query(SiteCounter.value).filter_by(name=HOT_PLAYERS_COUNTER).scalar() or 0
+
+
+def bump_hot_players_version():
+    """评价、订单完成状态变化时调用，随调用方事务提交。"""
+    _increment_counter(SiteCounter, {'name': HOT_PLAYERS_COUNTER}, value=1)
+
+
+def _photo_list(raw):
+    """User 上以 JSON 数组存的照片路径，格式不对时返回 []。"""
+    try:
+        photos = json.loads(raw) if raw else []
+    except (TypeError, ValueError):
+        return []
+    return photos if isinstance(photos, list) else []
+
+
+def build_hot_players():
+    """已审核打手的排行：完成数、平均分、评价数读 PlayerStats 口碑计数（一次联表查询），按（完成数，平均分）降序。"""
+    rows = db.session.query(
+        User.id, User.username, User.player_name, User.is_certified, User.live_room_url,
+        User.equipment_desc, User.preferred_games, User.environment_photos, User.equipment_photos,
+        PlayerStats.completed_count, PlayerStats.rating_sum, PlayerStats.rating_count
+    ).outerjoin(PlayerStats, PlayerStats.player_id == User.id).filter(
+        User.role == 'player',
+        User.is_approved == True
+    ).order_by(User.player_name).all()
     stats = []
-    for p in players_raw:
-        completed = Order.query.filter_by(player_id=p.id, status='已完成').count()
-        rating_rows = db.session.query(func.avg(Order.rating)).filter(
-            Order.player_id == p.id,
-            Order.status == '已完成',
-            Order.rating.isnot(None)
-        ).scalar()
-        avg_rating = round(float(rating_rows or 0), 1) if rating_rows is not None else None
-        env_photos = []
-        equip_photos = []
-        try:
-            if p.environment_photos:
-                env_photos = json.loads(p.environment_photos)
-            if not isinstance(env_photos, list):
-                env_photos = []
-        except (TypeError, ValueError):
-            pass
-        try:
-            if p.equipment_photos:
-                equip_photos = json.loads(p.equipment_photos)
-            if not isinstance(equip_photos, list):
-                equip_photos = []
-        except (TypeError, ValueError):
-            pass
+    for row in rows:
         stats.append({
-            'player': p,
-            'completed_count': completed,
-            'avg_rating': avg_rating,
-            'rating_count': Order.query.filter(
-                Order.player_id == p.id, Order.status == '已完成', Order.rating.isnot(None)
-            ).count(),
-            'env_photos': env_photos,
-            'equip_photos': equip_photos,
+            'player': HotPlayer(row.id, row.username, row.player_name, row.is_certified, row.live_room_url,
+                                row.equipment_desc, row.preferred_games),
+            'completed_count': row.completed_count or 0,
+            'avg_rating': round(row.rating_sum / row.rating_count, 1) if row.rating_count else None,
+            'rating_count': row.rating_count or 0,
+            'env_photos': _photo_list(row.environment_photos),
+            'equip_photos': _photo_list(row.equipment_photos),
         })
     stats.sort(key=lambda x: (x['completed_count'], x['avg_rating'] or 0), reverse=True)
-    return render_template('customer/hot_players.html', players=stats)
+    return stats
+
+
+def get_hot_players_snapshot():
+    """取热门打手排行快照；版本号未变且未超过 HOT_PLAYERS_TTL 时直接复用本进程缓存。
+    etag 按排行内容计算，内容不变时各 worker、各次重建得到同一个值。"""
+    global _hot_players_snapshot
+    version = hot_players_version()
+    snapshot = _hot_players_snapshot
+    if snapshot is None or snapshot.version != version or time.monotonic() - snapshot.built_at > HOT_PLAYERS_TTL:
+        players = build_hot_players()
+        digest = hashlib.sha1(json.dumps(
+            [dict(x, player=x['player']._asdict()) for x in players], ensure_ascii=False, sort_keys=True
+        ).encode('utf-8')).hexdigest()
+        snapshot = HotPlayersSnapshot(version, time.monotonic(), tuple(players), digest)
+        _hot_players_snapshot = snapshot
+    return snapshot
+
+
+@app.route('/hot-players')
+def hot_players():
+    snapshot = get_hot_players_snapshot()
+    # 未登录、也没有待显示提示的访客看到的页面只取决于快照，允许浏览器/CDN 缓存并按 ETag 协商；
+    # 已登录的页面带有个人导航，只允许浏览器私有缓存且每次协商
+    anonymous = not current_user.is_authenticated and not session.get('customer_id') and '_flashes' not in session
+    if anonymous and request.if_none_match.contains(snapshot.etag):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(render_template('customer/hot_players.html', players=snapshot.players))
+    if anonymous:
+        response.set_etag(snapshot.etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = HOT_PLAYERS_MAX_AGE
+    else:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
 
 
 @app.route('/customer/peiwan')
 def customer_peiwan_index():
     """陪玩价格表"""
-    prices = Price.query.filter_by(service_type='陪玩').order_by(Price.game, Price.task_type).all()
+    prices = get_price_catalog().prices('陪玩')
     grouped_prices = {}
     phone = request.args.get('phone', '')
     customer = None
@@ -1770,7 +2900,7 @@ def customer_peiwan_order():
                 db.session.add(customer)
                 db.session.commit()
 
-        price_item = Price.query.filter_by(game=game, task_type=task_type, service_type='陪玩').first()
+        price_item = get_price_catalog().get(game, task_type, '陪玩')
         if not price_item:
             flash('所选陪玩项目暂无定价，请从陪玩价格表选择')
             return redirect(url_for('customer_peiwan_order'))
@@ -1811,6 +2941,7 @@ def customer_peiwan_order():
         )
         db.session.add(order)
         db.session.flush()
+        apply_daily_stat_change(None, order_daily_stat(order))
         if coupon_obj:
             order.coupon_id = coupon_obj.id
             coupon_obj.used_by = customer.id
@@ -1820,11 +2951,10 @@ def customer_peiwan_order():
         flash('陪玩订单提交成功，请完成支付')
         return redirect(url_for('customer_pay', order_id=order.id))
 
-    games = db.session.query(Price.game).filter_by(service_type='陪玩').distinct().all()
+    catalog = get_price_catalog()
+    games = [(g,) for g in catalog.games('陪玩')]
     price_data = {}
-    for g in games:
-        game = g[0]
-        tasks = Price.query.filter_by(game=game, service_type='陪玩').all()
+    for game, tasks in catalog.grouped('陪玩').items():
         price_data[game] = [{'task_type': t.task_type, 'price': t.price, 'unit': t.unit or '元/小时'} for t in tasks]
     current_customer = None
     if session.get('customer_id'):
@@ -1868,9 +2998,7 @@ def customer_order():
                 db.session.add(customer)
                 db.session.commit()
 
-        price_item = Price.query.filter_by(game=game, task_type=task_type).filter(
-            db.or_(Price.service_type == '代肝', Price.service_type.is_(None))
-        ).first()
+        price_item = get_price_catalog().get(game, task_type, '代肝')
         if not price_item:
             flash('所选游戏或任务类型暂无定价，请联系管理员')
             return redirect(url_for('customer_order'))
@@ -1935,6 +3063,7 @@ def customer_order():
         )
         db.session.add(order)
         db.session.flush()
+        apply_daily_stat_change(None, order_daily_stat(order))
         if coupon_obj:
             order.coupon_id = coupon_obj.id
             coupon_obj.used_by = customer.id
@@ -1944,15 +3073,10 @@ def customer_order():
         flash('订单提交成功，请完成支付')
         return redirect(url_for('customer_pay', order_id=order.id))
 
-    games = db.session.query(Price.game).filter(
-        db.or_(Price.service_type == '代肝', Price.service_type.is_(None))
-    ).distinct().all()
+    catalog = get_price_catalog()
+    games = [(g,) for g in catalog.games('代肝')]
     price_data = {}
-    for game_tuple in games:
-        game = game_tuple[0]
-        tasks = Price.query.filter_by(game=game).filter(
-            db.or_(Price.service_type == '代肝', Price.service_type.is_(None))
-        ).all()
+    for game, tasks in catalog.grouped('代肝').items():
         price_data[game] = [{'task_type': t.task_type, 'price': t.price} for t in tasks]
     default_games = ['原神', '鸣潮', '星铁', '终末地', '三角洲', '永劫无间']
     for g in default_games:
@@ -2052,8 +3176,7 @@ def customer_order_custom():
         return render_template('customer/order_custom_restrict.html', reason='login')
     if not _customer_has_annual_or_above(current_customer):
         return render_template('customer/order_custom_restrict.html', reason='upgrade')
-    games = db.session.query(Price.game).distinct().all()
-    games = [g[0] for g in games]
+    games = get_price_catalog().games()
     default_games = ['原神', '鸣潮', '星铁', '终末地', '三角洲', '永劫无间']
     for g in default_games:
         if g not in games:
@@ -2107,7 +3230,7 @@ def customer_request_submit():
                 file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
                 screenshot = filename
         # 二次元且未上架：仅推送给擅长该游戏的打手、20%平台费、完成后录入平台价
-        price_games = set(g[0] for g in db.session.query(Price.game).distinct().all())
+        price_games = set(get_price_catalog().games())
         default_games_set = {'原神', '鸣潮', '星铁', '终末地', '三角洲', '永劫无间'}
         games_set = price_games | default_games_set
         is_anime_no_display = (game in ANIME_GAMES_CUSTOMER_OFFER and game not in games_set)
@@ -2123,6 +3246,8 @@ def customer_request_submit():
             is_anime_no_display=is_anime_no_display,
         )
         db.session.add(req)
+        if is_anime_no_display:
+            notify_players_for_anime_request(req)
         db.session.commit()
         flash('您的需求已发布，打手可浏览并接单。接单后请完成支付，支付成功后才生成订单。')
         return redirect(url_for('customer_custom_request_detail', request_id=req.id))
@@ -2130,8 +3255,7 @@ def customer_request_submit():
     current_customer = None
     if session.get('customer_id'):
         current_customer = Customer.query.get(session['customer_id'])
-    games = db.session.query(Price.game).distinct().all()
-    games = [g[0] for g in games]
+    games = get_price_catalog().games()
     default_games = ['原神', '鸣潮', '星铁', '终末地', '三角洲', '永劫无间']
     for g in default_games:
         if g not in games:
@@ -2199,6 +3323,7 @@ def customer_custom_pay_confirm(request_id):
                 order.player_price = reward if reward is not None else 0
     db.session.add(order)
     db.session.flush()
+    apply_daily_stat_change(None, order_daily_stat(order))
     payment = Payment(order_id=order.id, amount=order.customer_price, method='微信', status='成功')
     db.session.add(payment)
     req.status = '已支付'
@@ -2299,8 +3424,9 @@ def customer_pay_confirm(order_id):
                 order_id=order.id, type='顾客已支付', content=f'订单 {order.order_no} 顾客已支付，请开始处理',
                 receiver_type='player', receiver_id=order.player_id
             ))
+        enqueue_dispatch(order.id)
         db.session.commit()
-        auto_assign_order(order.id)
+        wake_dispatch_worker()
         flash('支付成功！订单已提交，我们将尽快为您安排打手。')
         return redirect(url_for('customer_order_detail', order_id=order.id))
 
@@ -2338,8 +3464,9 @@ def customer_pay_confirm(order_id):
             receiver_id=order.player_id
         ))
 
+    enqueue_dispatch(order.id)
     db.session.commit()
-    auto_assign_order(order.id)
+    wake_dispatch_worker()
     flash('支付成功！订单已提交，我们将尽快为您安排打手。')
     return redirect(url_for('customer_order_detail', order_id=order.id))
 
@@ -2350,8 +3477,24 @@ def customer_rate(order_id):
         flash('订单尚未完成，暂不能评价')
         return redirect(url_for('customer_order_detail', order_id=order.id))
     if request.method == 'POST':
-        order.rating = int(request.form['rating'])
-        order.comment = request.form['comment']
+        old_rating = order.rating
+        # 条件更新：两次并发的首次评价只有一方计入 rating_count
+        rated = Order.query.filter(
+            Order.id == order.id,
+            Order.status == '已完成',
+            Order.rating.is_(None) if old_rating is None else Order.rating == old_rating
+        ).update({'rating': int(request.form['rating']), 'comment': request.form['comment']}, synchronize_session=False)
+        db.session.expire(order, ['rating', 'comment'])
+        if not rated:
+            db.session.rollback()
+            flash('评价已被修改，请刷新后重试')
+            return redirect(url_for('customer_order_detail', order_id=order.id))
+        if order.player_id and order.rating != old_rating:
+            if old_rating is None:
+                _increment_counter(PlayerStats, {'player_id': order.player_id}, rating_sum=order.rating, rating_count=1)
+            else:
+                _increment_counter(PlayerStats, {'player_id': order.player_id}, rating_sum=order.rating - old_rating)
+        bump_hot_players_version()
         db.session.commit()
         flash('感谢您的评价！')
         return redirect(url_for('customer_order_detail', order_id=order.id))
@@ -2579,6 +3722,7 @@ def customer_gift_pay_confirm():
             message=order.message
         )
         db.session.add(gift)
+        on_gift_order_paid(order)
         n = Notification(
             type='顾客赠送礼物',
             content=f'顾客 {order.customer.name or order.customer.phone} 向您赠送了【{order.gift_product.name}】￥{order.amount}',
@@ -2775,136 +3919,298 @@ def admin_prices():
     return render_template('admin/prices.html', prices=prices, price_table_images=list_price_table_images(), service_type=service_type)
 
 
+# 价格行解析用的预编译表。标题行关键字 -> 游戏名，按顺序取第一个命中的
+_TITLE_GAMES = (('终末地', '终末地'), ('明日方舟', '终末地'), ('原神', '原神'), ('星铁', '星铁'),
+                ('鸣潮', '鸣潮'), ('永劫无间', '永劫无间'), ('三角洲', '三角洲'))
+# 分区标题规则，按顺序匹配：(分区, 行内含, 行首为, 行长 ≤ 8 时行首为, 行长 ≤ 8 时行内含)
+_SECTION_RULES = (
+    ('主线', ('主线任务',), (), ('主线',), ()),
+    ('支线', ('支线任务',), (), ('支线',), ()),
+    ('日常', ('日常托管',), ('日常',), (), ()),
+    ('探索', ('探索类',), ('探索',), (), ()),
+    ('基建', ('基建',), (), (), ()),
+    ('次要', ('次要任务',), (), (), ('次要',)),
+    ('功能', ('功能任务',), (), (), ('功能',)),
+    ('开荒', ('至尊开荒', '开荒托管'), (), (), ()),
+)
+_SECTION_NAMES = tuple(rule[0] for rule in _SECTION_RULES)
+# 预筛：价格行绝大多数一次 search 即可排除。短行的规则关键字都含分区名之一；
+# 长行只看「行内含」「行首为」两列和编号标题
+_SECTION_HINT_RE = re.compile('|'.join(_SECTION_NAMES) + '|[二三四五六]、')
+_SECTION_LONG_HINT_RE = re.compile('|'.join(
+    [k for rule in _SECTION_RULES for k in rule[1]] + ['^' + k for rule in _SECTION_RULES for k in rule[2]]
+) + '|[二三四五六]、')
+_SECTION_NUMBERED_RE = re.compile('[二三四五六]、')
+_HEADER_RE = re.compile('游戏|价格|任务类型|单位|备注|price list')
+# 价格单元格里要去掉的货币/单位符号和千分位逗号
+_PRICE_STRIP_RE = re.compile('[¥￥元/rR号图天月,]')
+
+
+def _detect_sheet_section(line):
+    """分区标题行返回分区名（「二、」等编号标题未写明分区时返回 ''），不是分区标题返回 None。"""
+    short = len(line) <= 8
+    if not (_SECTION_HINT_RE if short else _SECTION_LONG_HINT_RE).search(line):
+        return None
+    for section, anywhere, prefix, short_prefix, short_anywhere in _SECTION_RULES:
+        if (any(k in line for k in anywhere) or line.startswith(prefix)
+                or (short and (line.startswith(short_prefix) or any(k in line for k in short_anywhere)))):
+            return section
+    if _SECTION_NUMBERED_RE.search(line):
+        return next((s for s in _SECTION_NAMES if s in line), '')
+    return None
+
+
 def _parse_text_to_price_rows(text):
     """从纯文本中解析价格行，返回 [(game, task_type, price, unit), ...]。
     支持带「主线任务」「支线任务」分区的价格表，以及标题中含游戏名（如 明日方舟:终末地）。"""
-    import re
     rows = []
-    skip_headers = ('游戏', '价格', '任务类型', '单位', '备注', 'price list')
     lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
     default_game = None
-    current_section = None
     # 从标题行推断游戏名（如 明日方舟:终末地代肝价格表 -> 终末地）
     for ln in lines[:5]:
-        if '终末地' in ln:
-            default_game = '终末地'
-            break
-        if '明日方舟' in ln and '终末地' not in ln:
-            default_game = '终末地'
-            break
-        for g in ('原神', '星铁', '鸣潮', '永劫无间', '三角洲'):
-            if g in ln:
-                default_game = g
-                break
+        default_game = next((g for k, g in _TITLE_GAMES if k in ln), None)
         if default_game:
             break
+    # 无标题游戏名、且行里只有任务名时用的游戏
+    fallback_game = '终末地' if '终末' in text[:200] else None
+    current_section = None
     for line in lines:
-        if not line or len(line) < 2:
-            continue
-        # 分区标题：主线/支线/日常托管/探索类/基建/次要/功能/开荒
-        if '主线任务' in line or (len(line) <= 8 and line.startswith('主线')):
-            current_section = '主线'
-            continue
-        if '支线任务' in line or (len(line) <= 8 and line.startswith('支线')):
-            current_section = '支线'
-            continue
-        if '日常托管' in line or '日常' == line[:2]:
-            current_section = '日常'
-            continue
-        if '探索类' in line or '探索' == line[:2]:
-            current_section = '探索'
-            continue
-        if '基建滑索' in line or '基建' in line:
-            current_section = '基建'
-            continue
-        if '次要任务' in line or (len(line) <= 8 and '次要' in line):
-            current_section = '次要'
-            continue
-        if '功能任务' in line or (len(line) <= 8 and '功能' in line):
-            current_section = '功能'
+        if len(line) < 2:
             continue
-        if '至尊开荒' in line or '开荒托管' in line:
-            current_section = '开荒'
+        section = _detect_sheet_section(line)
+        if section is not None:
+            if section:
+                current_section = section
             continue
-        if '二、' in line or '三、' in line or '四、' in line or '五、' in line or '六、' in line:
-            if '主线' in line:
-                current_section = '主线'
-            elif '支线' in line:
-                current_section = '支线'
-            elif '日常' in line:
-                current_section = '日常'
-            elif '探索' in line:
-                current_section = '探索'
-            elif '基建' in line:
-                current_section = '基建'
-            elif '次要' in line:
-                current_section = '次要'
-            elif '功能' in line:
-                current_section = '功能'
-            elif '开荒' in line:
-                current_section = '开荒'
-            continue
-        parts = re.split(r'\s+|[　\t]+', line)
-        parts = [p.strip() for p in parts if p.strip()]
+        parts = line.split()
         if len(parts) < 2:
             continue
+        # 从右往左取第一个在 (0, 99999] 内的数作价格，它左边的是游戏/任务名
         price_val = None
-        rest = []
         for i in range(len(parts) - 1, -1, -1):
-            s = re.sub(r'[¥￥元/rR/号图天/月]', '', parts[i]).strip()
-            s = s.replace(',', '').replace('一月', '')
             try:
-                price_val = float(s)
-                if price_val <= 0 or price_val > 99999:
-                    continue
-                rest = parts[:i]
-                break
+                val = float(_PRICE_STRIP_RE.sub('', parts[i]))
             except ValueError:
                 continue
-        if price_val is None:
-            try:
-                s = re.sub(r'[¥￥元/rR/号图天/月]', '', parts[-1]).strip()
-                s = s.replace(',', '').replace('一月', '')
-                price_val = float(s)
-                if price_val > 0 and price_val <= 99999:
-                    rest = parts[:-1]
-            except (ValueError, IndexError):
+            if val <= 0 or val > 99999:
                 continue
+            price_val, rest = val, parts[:i]
+            break
         if price_val is None or not rest:
             continue
-        if any(h in line for h in skip_headers) and len(rest) <= 2:
-            continue
-        task_name = ' '.join(rest)[:50] if len(rest) > 1 else (rest[0][:50] if rest else '')
-        if not task_name or not task_name.replace(' ', ''):
+        if len(rest) <= 2 and _HEADER_RE.search(line):
             continue
-        if current_section:
-            task_type = f'{current_section}-{task_name}'
+        task_name = ' '.join(rest)[:50]
+        if default_game:
+            game = default_game
+        elif len(rest) >= 2:
+            game, task_name = rest[0][:50], ' '.join(rest[1:])[:50]
         else:
-            task_type = task_name
-        game = default_game if default_game else (rest[0][:50] if rest else '未知')
-        if not default_game and len(rest) >= 2:
-            game, task_type = rest[0][:50], ' '.join(rest[1:])[:50]
-            if current_section:
-                task_type = f'{current_section}-{task_type}'
-        elif not default_game and len(rest) == 1:
-            game = '终末地' if '终末' in text[:200] else (rest[0][:50] if rest else '未知')
+            game = fallback_game or rest[0][:50]
+        task_type = f'{current_section}-{task_name}' if current_section else task_name
         rows.append((game, task_type, round(price_val, 2), '元/次'))
     return rows
 
 
+OCR_LANG = 'chi_sim+eng'
+
+
+def _otsu_threshold(gray):
+    """灰度图的 Otsu 全局阈值（按直方图计算，不依赖 numpy）。"""
+    hist = gray.histogram()[:256]
+    total = sum(hist)
+    sum_all = sum(i * h for i, h in enumerate(hist))
+    sum_bg, weight_bg, best, threshold = 0, 0, -1, 127
+    for i, h in enumerate(hist):
+        weight_bg += h
+        if weight_bg == 0:
+            continue
+        weight_fg = total - weight_bg
+        if weight_fg == 0:
+            break
+        sum_bg += i * h
+        mean_bg = sum_bg / weight_bg
+        mean_fg = (sum_all - sum_bg) / weight_fg
+        between = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+        if between > best:
+            best, threshold = between, i
+    return threshold
+
+
+def _preprocess_ocr_image(img):
+    """OCR 前预处理：转灰度 → 宽度超过 OCR_MAX_WIDTH 时等比缩小（手机截图文字足够大，缩小不影响识别）→ Otsu 二值化。"""
+    from PIL import Image
+    gray = img.convert('L')
+    if gray.width > OCR_MAX_WIDTH:
+        height = max(1, round(gray.height * OCR_MAX_WIDTH / gray.width))
+        gray = gray.resize((OCR_MAX_WIDTH, height), Image.LANCZOS)
+    threshold = _otsu_threshold(gray)
+    return gray.point(lambda v: 255 if v > threshold else 0)
+
+
+def _ocr_tile_ranges(height):
+    """把高 height 的图切成 [(top, bottom, keep_from, keep_to), ...]：相邻分块重叠 OCR_TILE_OVERLAP 像素，
+    每块只保留中心线落在 [keep_from, keep_to) 的文字行，重叠区的行因此只会被保留一次。"""
+    if height <= OCR_TILE_HEIGHT:
+        return [(0, height, 0, height)]
+    step = OCR_TILE_HEIGHT - OCR_TILE_OVERLAP
+    tops = list(range(0, height - OCR_TILE_OVERLAP, step))
+    ranges = []
+    for k, top in enumerate(tops):
+        bottom = min(top + OCR_TILE_HEIGHT, height)
+        keep_from = top + OCR_TILE_OVERLAP // 2 if k > 0 else 0
+        keep_to = bottom - OCR_TILE_OVERLAP // 2 if k < len(tops) - 1 else height
+        ranges.append((top, bottom, keep_from, keep_to))
+    return ranges
+
+
+# ---------- OCR 常驻进程池 ----------
+# pytesseract 每次调用都新起 tesseract 进程并重新加载 chi_sim+eng 语言包，批量导入时大半时间耗在这里。
+# 改为固定数量的常驻进程：进程启动时加载一次 tesserocr 引擎（未安装时退回 pytesseract），之后只传图片。
+# 排队名额用信号量限制，并发上传再多也只占 OCR_POOL_PROCESSES 个进程、OCR_QUEUE_SIZE 个排队位。
+#
+# OCR 只在识别任务里执行，整机上同时存在的 OCR 引擎数（以下「调度进程」指开了 IMPORT_WORKER_THREADS
+# 的 web worker 进程与 flask import-worker 进程）：
+# - IMPORT_WORKER_PROCESSES > 0（默认）：解析子进程就是 OCR 执行者，子进程内不再起 OCR 进程池
+#   （_import_pool_init 把 OCR_POOL_PROCESSES 置 0），每个子进程一个常驻引擎，
+#   上限 = 调度进程数 × IMPORT_WORKER_PROCESSES；
+# - IMPORT_WORKER_PROCESSES = 0：在调度进程内解析，上限 = 调度进程数 × OCR_POOL_PROCESSES。
+# 生产上建议 IMPORT_WORKER_THREADS=0 并只跑一个 flask import-worker，上限即 IMPORT_WORKER_PROCESSES。
+# 未装 tesserocr 时每次识别由 pytesseract 临时起 tesseract 进程，分块并行时每个执行者最多 OCR_TILE_WORKERS 个。
+_ocr_engine = None  # 当前进程内的 tesserocr 引擎；False 表示不可用，退回 pytesseract
+_ocr_engine_lock = threading.Lock()
+_ocr_pool = None
+_ocr_pool_lock = threading.Lock()
+_ocr_slots = threading.BoundedSemaphore(max(1, OCR_POOL_PROCESSES) + max(0, OCR_QUEUE_SIZE))
+
+
+def _ocr_engine_init():
+    """加载 tesserocr 引擎（OCR 进程的 initializer，也用于进程内识别）。"""
+    global _ocr_engine
+    try:
+        import tesserocr
+        _ocr_engine = tesserocr.PyTessBaseAPI(lang=OCR_LANG)
+    except Exception:
+        _ocr_engine = False
+
+
+def _ocr_run(mode, img):
+    """在 OCR 进程中执行。mode='text' 返回全文；mode='lines' 返回 [(行上沿, 行下沿, 行文本), ...]。"""
+    if _ocr_engine is None:
+        _ocr_engine_init()
+    if _ocr_engine:
+        import tesserocr
+        _ocr_engine.SetImage(img)
+        if mode == 'text':
+            return _ocr_engine.GetUTF8Text()
+        _ocr_engine.Recognize()
+        level = tesserocr.RIL.TEXTLINE
+        lines = []
+        for r in tesserocr.iterate_level(_ocr_engine.GetIterator(), level):
+            text = ' '.join((r.GetUTF8Text(level) or '').split())
+            box = r.BoundingBox(level)
+            if text and box:
+                lines.append((box[1], box[3], text))
+        return lines
+    import pytesseract
+    if mode == 'text':
+        return pytesseract.image_to_string(img, lang=OCR_LANG)
+    data = pytesseract.image_to_data(img, lang=OCR_LANG, output_type=pytesseract.Output.DICT)
+    lines = {}
+    for i, word in enumerate(data['text']):
+        if not (word or '').strip():
+            continue
+        key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        y0, y1 = data['top'][i], data['top'][i] + data['height'][i]
+        line = lines.setdefault(key, {'y0': y0, 'y1': y1, 'words': []})
+        line['y0'], line['y1'] = min(line['y0'], y0), max(line['y1'], y1)
+        line['words'].append((data['left'][i], word.strip()))
+    return [(line['y0'], line['y1'], ' '.join(w for _, w in sorted(line['words'])))
+            for line in lines.values()]
+
+
+def _get_ocr_pool():
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is None:
+            _ocr_pool = ProcessPoolExecutor(max_workers=OCR_POOL_PROCESSES, initializer=_ocr_engine_init)
+        return _ocr_pool
+
+
+def _reset_ocr_pool():
+    global _ocr_pool
+    with _ocr_pool_lock:
+        pool, _ocr_pool = _ocr_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def ocr_submit(mode, img):
+    """把一张图交给 OCR 进程池识别并等待结果（参数同 _ocr_run）。
+    排队已满时最多等 OCR_QUEUE_TIMEOUT 秒，仍无空位抛 RuntimeError；OCR_POOL_PROCESSES=0 时在当前进程识别。"""
+    if not _ocr_slots.acquire(timeout=OCR_QUEUE_TIMEOUT):
+        raise RuntimeError('OCR 繁忙，请稍后重试')
+    try:
+        if OCR_POOL_PROCESSES <= 0:
+            if _ocr_engine is None:
+                with _ocr_engine_lock:
+                    if _ocr_engine is None:
+                        _ocr_engine_init()
+            if _ocr_engine:
+                # tesserocr 引擎不是线程安全的，进程内识别时串行使用；pytesseract 每次另起进程，无需加锁
+                with _ocr_engine_lock:
+                    return _ocr_run(mode, img)
+            return _ocr_run(mode, img)
+        try:
+            return _get_ocr_pool().submit(_ocr_run, mode, img).result()
+        except BrokenProcessPool:
+            _reset_ocr_pool()
+            raise
+    finally:
+        _ocr_slots.release()
+
+
+def _ocr_tile_lines(img, top, bottom, keep_from, keep_to):
+    """识别一个分块，返回 [(行中心 y, 行文本), ...]（坐标换算回整图）。
+    碰到分块上下边缘的行可能被切断，丢弃；它在相邻分块中是完整的。"""
+    tile = img.crop((0, top, img.width, bottom))
+    result = []
+    for y0, y1, text in ocr_submit('lines', tile):
+        if (y0 <= 1 and top > 0) or (y1 >= tile.height - 1 and bottom < img.height):
+            continue
+        center = top + (y0 + y1) / 2
+        if keep_from <= center < keep_to:
+            result.append((center, text))
+    return result
+
+
+def _ocr_preprocessed_image(img):
+    """对预处理后的图做 OCR：不高的图整张识别；长截图切成重叠分块并行识别，按行位置拼回全文。"""
+    ranges = _ocr_tile_ranges(img.height)
+    if len(ranges) == 1:
+        return ocr_submit('text', img)
+    with ThreadPoolExecutor(max_workers=max(1, min(OCR_TILE_WORKERS, len(ranges)))) as pool:
+        tiles = list(pool.map(lambda r: _ocr_tile_lines(img, *r), ranges))
+    lines = sorted((line for tile in tiles for line in tile), key=lambda x: x[0])
+    return '\n'.join(text for _, text in lines)
+
+
 def _ocr_image_to_text(image_path):
-    """对图片做 OCR 返回文本，失败返回 None。"""
+    """对图片做 OCR 返回文本，失败返回 None。默认先做灰度/缩放/二值化预处理，长截图分块并行识别（OCR_PREPROCESS=0 关闭）。
+    识别交给常驻 OCR 进程池，见 ocr_submit。"""
     try:
-        import pytesseract
         from PIL import Image
     except ImportError:
         return None
     try:
         img = Image.open(image_path)
+        if OCR_PREPROCESS:
+            text = _ocr_preprocessed_image(_preprocess_ocr_image(img))
+            return text or None
         # 若为 RGBA 转 RGB
         if img.mode == 'RGBA':
             img = img.convert('RGB')
-        text = pytesseract.image_to_string(img, lang='chi_sim+eng')
+        text = ocr_submit('text', img)
         return text or None
     except Exception:
         return None
@@ -2923,82 +4229,558 @@ def _parse_image_prices(image_path):
     return rows, None
 
 
-def _parse_pdf_prices(pdf_path):
-    """从 PDF 中解析出 (game, task_type, price, unit) 列表。支持表格或文本行。"""
+def _parse_pdf_page(page):
+    """解析单页 PDF：优先取表格，无表格时按文本行解析。返回该页的 [(game, task_type, price, unit), ...]。"""
+    rows = []
+    tables = page.extract_tables()
+    for table in tables:
+        if not table:
+            continue
+        for i, row in enumerate(table):
+            if not row or len(row) < 2:
+                continue
+            cells = [str(c).strip() if c is not None else '' for c in row]
+            cells = [c for c in cells if c]
+            if len(cells) < 2:
+                continue
+            # 跳过表头行（整行无数字或包含“游戏”“价格”等）
+            if i == 0 and all(not str(c).replace('.', '').replace('元', '').strip().isdigit() for c in cells):
+                head = ''.join(cells)
+                if '游戏' in head or '价格' in head or '任务' in head:
+                    continue
+            # 找价格：最后一个数字或唯一一个数字
+            price_val = None
+            rest = []
+            for c in cells:
+                s = str(c).replace('¥', '').replace('￥', '').replace('元', '').strip()
+                try:
+                    price_val = float(s)
+                    rest = [x for x in cells if x != c]
+                    break
+                except ValueError:
+                    rest.append(c)
+            if price_val is None and len(cells) >= 3:
+                try:
+                    price_val = float(str(cells[-1]).replace('¥', '').replace('￥', '').replace('元', '').strip())
+                    rest = cells[:-1]
+                except (ValueError, IndexError):
+                    pass
+            if price_val is None or price_val < 0:
+                continue
+            if len(rest) >= 2:
+                game, task_type = rest[0], rest[1]
+            elif len(rest) == 1:
+                game, task_type = rest[0], '默认'
+            else:
+                continue
+            if not game or not game.replace(' ', ''):
+                continue
+            unit = '元/次'
+            if len(cells) >= 4 and cells[3]:
+                unit = str(cells[3]).strip() or unit
+            rows.append((game[:50], task_type[:50], round(price_val, 2), unit[:20]))
+    if not tables:
+        text = page.extract_text()
+        if text:
+            for line in text.splitlines():
+                line = line.strip()
+                parts = line.split()
+                if len(parts) >= 3:
+                    try:
+                        price_val = float(parts[-1].replace('¥', '').replace('￥', ''))
+                        game, task_type = parts[0], ' '.join(parts[1:-1])
+                        if game and task_type:
+                            rows.append((game[:50], task_type[:50], round(price_val, 2), '元/次'))
+                    except (ValueError, IndexError):
+                        pass
+    return rows
+
+
+def _parse_pdf_page_range(pdf_path, start, end):
+    """在解析进程中执行：打开 PDF 解析第 start~end-1 页，返回 (每页结果列表, 错误信息)。"""
+    import pdfplumber
+    pages_rows = []
+    try:
+        with pdfplumber.open(pdf_path) as pdf:
+            for page in pdf.pages[start:end]:
+                pages_rows.append(_parse_pdf_page(page))
+    except Exception as e:
+        return pages_rows, str(e)
+    return pages_rows, None
+
+
+def _parse_pdf_prices(pdf_path, progress=None, workers=None):
+    """从 PDF 中解析出 (game, task_type, price, unit) 列表。支持表格或文本行。
+    progress(done, total) 每解析完一页回调一次（识别任务用来回写进度）。
+    workers（默认 PDF_PARSE_WORKERS）> 1 且页数足够时，按页段分给多个进程并行解析，按页序合并，结果与逐页解析一致。"""
     try:
         import pdfplumber
     except ImportError:
         return None, '请先安装: pip install pdfplumber'
+    workers = PDF_PARSE_WORKERS if workers is None else workers
     rows = []
     try:
         with pdfplumber.open(pdf_path) as pdf:
-            for page in pdf.pages:
-                tables = page.extract_tables()
-                for table in tables:
-                    if not table:
-                        continue
-                    for i, row in enumerate(table):
-                        if not row or len(row) < 2:
-                            continue
-                        cells = [str(c).strip() if c is not None else '' for c in row]
-                        cells = [c for c in cells if c]
-                        if len(cells) < 2:
-                            continue
-                        # 跳过表头行（整行无数字或包含“游戏”“价格”等）
-                        if i == 0 and all(not str(c).replace('.', '').replace('元', '').strip().isdigit() for c in cells):
-                            head = ''.join(cells)
-                            if '游戏' in head or '价格' in head or '任务' in head:
-                                continue
-                        # 找价格：最后一个数字或唯一一个数字
-                        price_val = None
-                        rest = []
-                        for c in cells:
-                            s = str(c).replace('¥', '').replace('￥', '').replace('元', '').strip()
-                            try:
-                                price_val = float(s)
-                                rest = [x for x in cells if x != c]
-                                break
-                            except ValueError:
-                                rest.append(c)
-                        if price_val is None and len(cells) >= 3:
-                            try:
-                                price_val = float(str(cells[-1]).replace('¥', '').replace('￥', '').replace('元', '').strip())
-                                rest = cells[:-1]
-                            except (ValueError, IndexError):
-                                pass
-                        if price_val is None or price_val < 0:
-                            continue
-                        if len(rest) >= 2:
-                            game, task_type = rest[0], rest[1]
-                        elif len(rest) == 1:
-                            game, task_type = rest[0], '默认'
-                        else:
-                            continue
-                        if not game or not game.replace(' ', ''):
-                            continue
-                        unit = '元/次'
-                        if len(cells) >= 4 and cells[3]:
-                            unit = str(cells[3]).strip() or unit
-                        rows.append((game[:50], task_type[:50], round(price_val, 2), unit[:20]))
-                if not tables:
-                    text = page.extract_text()
-                    if text:
-                        for line in text.splitlines():
-                            line = line.strip()
-                            parts = line.split()
-                            if len(parts) >= 3:
-                                try:
-                                    price_val = float(parts[-1].replace('¥', '').replace('￥', ''))
-                                    game, task_type = parts[0], ' '.join(parts[1:-1])
-                                    if game and task_type:
-                                        rows.append((game[:50], task_type[:50], round(price_val, 2), '元/次'))
-                                except (ValueError, IndexError):
-                                    pass
+            total_pages = len(pdf.pages)
+            if progress:
+                progress(0, total_pages)
+            if workers <= 1 or total_pages < PDF_PARSE_MIN_PAGES:
+                for page_no, page in enumerate(pdf.pages, 1):
+                    rows.extend(_parse_pdf_page(page))
+                    if progress:
+                        progress(page_no, total_pages)
+                return rows, None
+    except Exception as e:
+        return None, str(e)
+    # 并行：页段数取进程数的 2 倍，各段大小相近，避免某个进程拖尾
+    chunk = max(1, -(-total_pages // (workers * 2)))
+    ranges = [(start, min(start + chunk, total_pages)) for start in range(0, total_pages, chunk)]
+    results = [None] * len(ranges)
+    done = 0
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as pool:
+            futures = {pool.submit(_parse_pdf_page_range, pdf_path, start, end): i
+                       for i, (start, end) in enumerate(ranges)}
+            for future in as_completed(futures):
+                i = futures[future]
+                results[i] = future.result()
+                done += len(results[i][0])
+                if progress:
+                    progress(done, total_pages)
     except Exception as e:
         return None, str(e)
+    # 按页序合并；与逐页解析一样，遇到第一个出错的页即返回错误
+    for pages_rows, err in results:
+        for page_rows in pages_rows:
+            rows.extend(page_rows)
+        if err:
+            return None, err
     return rows, None
 
 
+# ---------- 价格表导入（预览后批量写入）----------
+def plan_price_import(rows, catalog):
+    """把解析出的 [(game, task_type, price, unit), ...] 与价格目录在内存中比对，生成导入差异。
+    返回 [{'action': 'insert'|'update'|'unchanged', 'id', 'game', 'task_type', 'price', 'unit',
+    'old_price', 'old_unit', 'source'}, ...]；同一平台项被多行命中时以最后一行为准（与逐行写库一致）。"""
+    plan = []
+    by_id = {}
+    pending = {}
+    for game, task_type, price, unit in rows:
+        ref = _match_platform_price(game, task_type, catalog, pending)
+        source = f'{game} - {task_type}'
+        if isinstance(ref, PriceEntry):
+            item = by_id.get(ref.id)
+            if item is None:
+                item = {'action': 'update', 'id': ref.id, 'game': ref.game, 'task_type': ref.task_type,
+                        'price': ref.price, 'unit': ref.unit, 'old_price': ref.price, 'old_unit': ref.unit}
+                by_id[ref.id] = item
+                plan.append(item)
+            item['price'] = price
+            item['unit'] = unit or item['unit']
+            item['source'] = source
+        elif ref is not None:
+            # 命中本次导入新增的行
+            ref['price'] = price
+            ref['unit'] = unit or ref['unit']
+            ref['source'] = source
+        else:
+            item = {'action': 'insert', 'id': None, 'game': game.strip()[:50], 'task_type': task_type.strip()[:50],
+                    'price': price, 'unit': unit or '元/次', 'old_price': None, 'old_unit': None, 'source': source}
+            pending.setdefault(item['game'], TaskMatchIndex()).add(item['task_type'], item)
+            plan.append(item)
+    for item in plan:
+        if item['action'] == 'update' and item['price'] == item['old_price'] and item['unit'] == item['old_unit']:
+            item['action'] = 'unchanged'
+    return plan
+
+
+def apply_price_import_plan(plan, version):
+    """按差异批量写库：更新按主键 executemany，新增一次 executemany 插入。
+    以价格目录版本号做乐观锁：预览之后价格表若被改过（版本号已变）则不写入并返回 False。
+    随调用方事务提交。"""
+    if version:
+        bumped = SiteCounter.query.filter_by(name=PRICE_CATALOG_COUNTER, value=version).update(
+            {SiteCounter.value: SiteCounter.value + 1}, synchronize_session=False)
+        if not bumped:
+            return False
+    elif price_catalog_version():
+        return False
+    else:
+        bump_price_catalog_version()
+    updates = [{'id': x['id'], 'price': x['price'], 'unit': x['unit']} for x in plan if x['action'] == 'update']
+    inserts = [{'game': x['game'], 'task_type': x['task_type'], 'price': x['price'], 'unit': x['unit']}
+               for x in plan if x['action'] == 'insert']
+    if updates:
+        db.session.bulk_update_mappings(Price, updates)
+    if inserts:
+        db.session.bulk_insert_mappings(Price, inserts)
+    return True
+
+
+def _price_import_draft_path(token):
+    import tempfile
+    return os.path.join(tempfile.gettempdir(), f'price_import_{token}.json')
+
+
+def _save_price_import_draft(draft):
+    """导入预览暂存到临时文件（各 worker 共享），返回 token。"""
+    token = secrets.token_urlsafe(16)
+    with open(_price_import_draft_path(token), 'w', encoding='utf-8') as fp:
+        json.dump(draft, fp, ensure_ascii=False)
+    return token
+
+
+def _load_price_import_draft(token):
+    if not token or not re.fullmatch(r'[A-Za-z0-9_-]+', token):
+        return None
+    try:
+        with open(_price_import_draft_path(token), encoding='utf-8') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def _discard_price_import_draft(token):
+    try:
+        os.remove(_price_import_draft_path(token))
+    except OSError:
+        pass
+
+
+# 导入预览来源 -> 重新上传的页面
+PRICE_IMPORT_UPLOAD_ENDPOINTS = {
+    'pdf': 'admin_price_import_pdf',
+    'image': 'admin_price_import_image',
+    'bulk': 'admin_price_import_bulk',
+}
+
+
+def _render_price_import_preview(source, filename, rows, notice=None):
+    """比对价格目录生成差异并展示预览页，确认后由 admin_price_import_confirm 写入。"""
+    catalog = get_price_catalog()
+    plan = plan_price_import(rows, catalog)
+    token = _save_price_import_draft({
+        'source': source,
+        'filename': filename,
+        'version': catalog.version,
+        'rows': [list(r) for r in rows],
+        'plan': plan,
+    })
+    counts = {action: sum(1 for x in plan if x['action'] == action) for action in ('insert', 'update', 'unchanged')}
+    return render_template('admin/price_import_preview.html', plan=plan, counts=counts, token=token,
+                           source=source, filename=filename, total=len(rows), notice=notice,
+                           upload_endpoint=PRICE_IMPORT_UPLOAD_ENDPOINTS.get(source, 'admin_price_import_pdf'))
+
+
+# ---------- 价格表解析缓存 ----------
+# 同一张价格表图片/PDF 常被管理员和多位打手反复上传。按文件内容 SHA-256 + 解析器版本缓存解析结果，
+# 命中时完全跳过 pdfplumber / Tesseract。解析规则有改动时递增对应版本号，旧缓存自然不再命中。
+PARSER_VERSIONS = {'pdf': 'pdf-1', 'image': 'ocr-2'}
+PARSE_CACHE_HIT_COUNTER = 'parse_cache_hit'
+PARSE_CACHE_MISS_COUNTER = 'parse_cache_miss'
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def get_cached_parse(digest, kind):
+    """查解析缓存，命中返回 rows 并刷新最近使用时间，未命中返回 None；同时累计命中/未命中次数。随调用方事务提交。"""
+    entry = ParseCache.query.filter_by(digest=digest, kind=kind, parser_version=PARSER_VERSIONS[kind]).first()
+    if entry is None:
+        _increment_counter(SiteCounter, {'name': PARSE_CACHE_MISS_COUNTER}, value=1)
+        return None
+    ParseCache.query.filter_by(id=entry.id).update(
+        {'hits': ParseCache.hits + 1, 'last_used_at': datetime.utcnow()}, synchronize_session=False)
+    _increment_counter(SiteCounter, {'name': PARSE_CACHE_HIT_COUNTER}, value=1)
+    return [tuple(r) for r in json.loads(entry.rows)]
+
+
+def store_parse_cache(digest, kind, rows):
+    """写入解析缓存并按 PARSE_CACHE_MAX_BYTES 淘汰最久未用的条目。随调用方事务提交。"""
+    payload = json.dumps([list(r) for r in rows], ensure_ascii=False)
+    try:
+        with db.session.begin_nested():
+            db.session.add(ParseCache(digest=digest, kind=kind, parser_version=PARSER_VERSIONS[kind],
+                                      rows=payload, size_bytes=len(payload.encode('utf-8'))))
+    except IntegrityError:
+        # 另一进程刚解析完同一文件
+        return
+    total = db.session.query(func.coalesce(func.sum(ParseCache.size_bytes), 0)).scalar()
+    if total <= PARSE_CACHE_MAX_BYTES:
+        return
+    evict = []
+    for entry_id, size in db.session.query(ParseCache.id, ParseCache.size_bytes).order_by(
+            ParseCache.last_used_at, ParseCache.id):
+        if total <= PARSE_CACHE_MAX_BYTES:
+            break
+        evict.append(entry_id)
+        total -= size or 0
+    if evict:
+        ParseCache.query.filter(ParseCache.id.in_(evict)).delete(synchronize_session=False)
+
+
+def parse_cache_stats():
+    """导入页展示用：缓存命中/未命中次数、缓存文件数与大小。"""
+    counters = dict(db.session.query(SiteCounter.name, SiteCounter.value).filter(
+        SiteCounter.name.in_([PARSE_CACHE_HIT_COUNTER, PARSE_CACHE_MISS_COUNTER])).all())
+    entries, size = db.session.query(func.count(ParseCache.id), func.coalesce(func.sum(ParseCache.size_bytes), 0)).one()
+    return {
+        'hits': counters.get(PARSE_CACHE_HIT_COUNTER, 0),
+        'misses': counters.get(PARSE_CACHE_MISS_COUNTER, 0),
+        'entries': entries,
+        'size_kb': round(size / 1024, 1),
+    }
+
+
+# ---------- 价格表识别任务（后台进程池解析）----------
+# pdfplumber / Tesseract 解析可能要几十秒，不在 web 请求里做：上传只建 ImportJob 并入队，
+# 调度线程（或独立进程 flask import-worker）认领任务交给进程池解析，页面轮询 JSON 状态。
+_import_wakeup = threading.Event()
+_import_threads = []
+_import_threads_lock = threading.Lock()
+_import_pool = None
+
+
+def create_import_job(file_storage, kind, purpose, batch=None):
+    """保存上传文件并创建识别任务（随调用方事务提交），提交后再调用 wake_import_worker。
+    kind: 'pdf' / 'image'；purpose: 'platform'（平台价格表）/ 'player'（打手报价）；batch: 批量导入批次号。"""
+    ext = '.pdf' if kind == 'pdf' else os.path.splitext(secure_filename(file_storage.filename))[1].lower()
+    name = f"{purpose}_{current_user.id}_{secrets.token_hex(8)}{ext}"
+    path = os.path.join(UPLOAD_IMPORT_JOB_DIR, name)
+    file_storage.save(path)
+    job = ImportJob(user_id=current_user.id, kind=kind, purpose=purpose,
+                    filename=(file_storage.filename or name)[:200], file_path=path, status='queued', batch=batch)
+    db.session.add(job)
+    return job
+
+
+def wake_import_worker():
+    """唤醒进程内识别任务调度线程；首次调用时按 IMPORT_WORKER_THREADS 启动。"""
+    if IMPORT_WORKER_THREADS <= 0:
+        return
+    with _import_threads_lock:
+        if not _import_threads:
+            for i in range(IMPORT_WORKER_THREADS):
+                t = threading.Thread(target=run_import_worker, name=f'import-worker-{i}', daemon=True)
+                t.start()
+                _import_threads.append(t)
+    _import_wakeup.set()
+
+
+def _import_pool_init():
+    global OCR_POOL_PROCESSES
+    # 子进程不能复用父进程的数据库连接
+    with app.app_context():
+        db.engine.dispose(close=False)
+    # 解析子进程本身就是 OCR 执行者，就地识别，不再各自起 OCR 进程池（整机上限见「OCR 常驻进程池」）
+    OCR_POOL_PROCESSES = 0
+
+
+def _get_import_pool():
+    global _import_pool
+    if IMPORT_WORKER_PROCESSES <= 0:
+        return None
+    with _import_threads_lock:
+        if _import_pool is None:
+            _import_pool = ProcessPoolExecutor(max_workers=IMPORT_WORKER_PROCESSES, initializer=_import_pool_init)
+        return _import_pool
+
+
+def _reset_import_pool():
+    global _import_pool
+    with _import_threads_lock:
+        pool, _import_pool = _import_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _import_job_parse(job_id, kind, path):
+    """在解析进程中执行：先查解析缓存，未命中再解析文件并逐页回写进度，返回 (rows, error)。"""
+    with app.app_context():
+        def progress(done, total):
+            ImportJob.query.filter_by(id=job_id).update(
+                {'pages_done': done, 'pages_total': total}, synchronize_session=False)
+            db.session.commit()
+        try:
+            digest = file_sha256(path)
+            rows = get_cached_parse(digest, kind)
+            if rows is not None:
+                ImportJob.query.filter_by(id=job_id).update(
+                    {'cache_hit': True, 'pages_done': 1, 'pages_total': 1}, synchronize_session=False)
+                db.session.commit()
+                return [list(r) for r in rows], None
+            db.session.commit()
+            if kind == 'pdf':
+                rows, err = _parse_pdf_prices(path, progress=progress)
+            else:
+                progress(0, 1)
+                rows, err = _parse_image_prices(path)
+                progress(1, 1)
+            if err is None:
+                store_parse_cache(digest, kind, rows or [])
+                db.session.commit()
+        finally:
+            db.session.remove()
+    return [list(r) for r in rows] if rows else rows, err
+
+
+def _claim_import_jobs(limit):
+    """认领一批排队中的识别任务（条件更新，多进程并发时每个任务只会被一个 worker 拿到）。
+    解析中超过 30 分钟的任务视为 worker 已退出，重新认领。"""
+    stale_before = datetime.utcnow() - timedelta(minutes=30)
+    claimable = db.or_(
+        ImportJob.status == 'queued',
+        db.and_(ImportJob.status == 'running', ImportJob.started_at < stale_before)
+    )
+    ids = [row[0] for row in db.session.query(ImportJob.id).filter(claimable).order_by(ImportJob.id).limit(limit).all()]
+    claimed = []
+    for job_id in ids:
+        updated = ImportJob.query.filter(ImportJob.id == job_id, claimable).update(
+            {'status': 'running', 'started_at': datetime.utcnow()}, synchronize_session=False)
+        if updated:
+            claimed.append(job_id)
+    db.session.commit()
+    return claimed
+
+
+def _finish_import_job(job_id, rows, error):
+    job = ImportJob.query.get(job_id)
+    if not job:
+        return
+    if error is None and not rows:
+        error = '未能从文件中识别出有效价格行，请检查文件是否包含「游戏、任务类型、价格」'
+    job.status = 'failed' if error else 'done'
+    job.error = error[:500] if error else None
+    job.rows = json.dumps(rows, ensure_ascii=False) if rows else None
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    if job.file_path and os.path.exists(job.file_path):
+        try:
+            os.remove(job.file_path)
+        except OSError:
+            pass
+
+
+def process_import_jobs(limit=None):
+    """认领一批识别任务交给进程池并行解析，结果写回任务。返回本批处理的任务数。需在 app context 中调用。"""
+    claimed = _claim_import_jobs(limit or max(IMPORT_WORKER_PROCESSES, 1))
+    if not claimed:
+        return 0
+    tasks = {job_id: (kind, path) for job_id, kind, path in db.session.query(
+        ImportJob.id, ImportJob.kind, ImportJob.file_path).filter(ImportJob.id.in_(claimed)).all()}
+    pool = _get_import_pool()
+    if pool is None:
+        for job_id in claimed:
+            try:
+                rows, err = _import_job_parse(job_id, *tasks[job_id])
+            except Exception as e:
+                app.logger.exception('价格表识别失败 job=%s', job_id)
+                rows, err = None, str(e)
+            _finish_import_job(job_id, rows, err)
+        return len(claimed)
+    futures = {pool.submit(_import_job_parse, job_id, *tasks[job_id]): job_id for job_id in claimed}
+    db.session.remove()
+    for future in as_completed(futures):
+        job_id = futures[future]
+        try:
+            rows, err = future.result()
+        except BrokenProcessPool as e:
+            _reset_import_pool()
+            rows, err = None, f'解析进程异常退出：{e}'
+        except Exception as e:
+            app.logger.exception('价格表识别失败 job=%s', job_id)
+            rows, err = None, str(e)
+        _finish_import_job(job_id, rows, err)
+    return len(claimed)
+
+
+def run_import_worker(stop_event=None):
+    """识别任务调度主循环：有任务就按批处理，队列空时等待唤醒或轮询间隔。"""
+    while not (stop_event and stop_event.is_set()):
+        try:
+            with app.app_context():
+                processed = process_import_jobs()
+        except Exception:
+            app.logger.exception('识别任务 worker 出错')
+            processed = 0
+        if not processed:
+            _import_wakeup.wait(IMPORT_POLL_SECONDS)
+            _import_wakeup.clear()
+
+
+def _start_import_job(file_storage, kind, purpose):
+    job = create_import_job(file_storage, kind, purpose)
+    db.session.commit()
+    wake_import_worker()
+    return redirect(url_for('import_job_detail', job_id=job.id))
+
+
+def _get_own_import_job(job_id):
+    job = ImportJob.query.get_or_404(job_id)
+    if job.user_id != current_user.id and current_user.role != 'admin':
+        abort(403)
+    return job
+
+
+@app.route('/import-job/<int:job_id>')
+@login_required
+def import_job_detail(job_id):
+    """识别任务进度页：解析中轮询状态，完成后展示识别结果供核对。"""
+    job = _get_own_import_job(job_id)
+    rows = json.loads(job.rows) if job.rows else []
+    return render_template('import_job.html', job=job, rows=rows, upload_endpoint=import_job_upload_endpoint(job))
+
+
+def import_job_upload_endpoint(job):
+    """识别任务的「重新上传」入口：打手回识别入口页；平台价格表按批量/PDF/图片回各自的上传页。"""
+    if job.purpose != 'platform':
+        return 'player_price_import'
+    if job.batch:
+        return PRICE_IMPORT_UPLOAD_ENDPOINTS['bulk']
+    return PRICE_IMPORT_UPLOAD_ENDPOINTS.get(job.kind, 'admin_price_import_pdf')
+
+
+@app.route('/import-job/<int:job_id>/status')
+@login_required
+def import_job_status(job_id):
+    job = _get_own_import_job(job_id)
+    return jsonify({
+        'id': job.id,
+        'status': job.status,
+        'pages_done': job.pages_done or 0,
+        'pages_total': job.pages_total,
+        'row_count': len(json.loads(job.rows)) if job.rows else 0,
+        'error': job.error,
+    })
+
+
+@app.route('/import-job/<int:job_id>/apply', methods=['POST'])
+@login_required
+def import_job_apply(job_id):
+    """核对后使用识别结果：平台价格表进入导入预览；打手报价直接与平台任务匹配填入。"""
+    job = _get_own_import_job(job_id)
+    if job.status != 'done' or not job.rows:
+        flash('识别任务尚未完成')
+        return redirect(url_for('import_job_detail', job_id=job.id))
+    rows = [tuple(r) for r in json.loads(job.rows)]
+    if job.purpose == 'platform':
+        if current_user.role != 'admin':
+            abort(403)
+        return _render_price_import_preview(job.kind, job.filename, rows)
+    if current_user.role != 'player':
+        abort(403)
+    matched, total = _apply_parsed_rows_to_player_quotes(rows)
+    db.session.commit()
+    flash(f'识别完成：共 {total} 条，其中 {matched} 条与平台任务匹配，已填入您的报价')
+    return redirect(url_for('player_my_prices'))
+
+
 @app.route('/admin/price/import-pdf', methods=['GET', 'POST'])
 @login_required
 def admin_price_import_pdf():
@@ -3012,37 +4794,8 @@ def admin_price_import_pdf():
         if not f.filename or not f.filename.lower().endswith('.pdf'):
             flash('请上传 PDF 文件')
             return redirect(url_for('admin_price_import_pdf'))
-        import tempfile
-        path = os.path.join(tempfile.gettempdir(), secure_filename(f.filename) or 'upload.pdf')
-        f.save(path)
-        try:
-            rows, err = _parse_pdf_prices(path)
-            if err:
-                flash('解析失败：' + err)
-                return redirect(url_for('admin_price_import_pdf'))
-            if not rows:
-                flash('未能从 PDF 中解析出有效价格行，请检查表格是否为「游戏、任务类型、价格」三列')
-                return redirect(url_for('admin_price_import_pdf'))
-            added, updated = 0, 0
-            for game, task_type, price, unit in rows:
-                p = _find_platform_price_fuzzy(game, task_type)
-                if p:
-                    p.price = price
-                    p.unit = unit or p.unit
-                    updated += 1
-                else:
-                    db.session.add(Price(game=game.strip()[:50], task_type=task_type.strip()[:50], price=price, unit=unit or '元/次'))
-                    added += 1
-            db.session.commit()
-            flash(f'导入成功：新增 {added} 条，更新 {updated} 条（已做模糊匹配合并）')
-        finally:
-            if os.path.exists(path):
-                try:
-                    os.remove(path)
-                except OSError:
-                    pass
-        return redirect(url_for('admin_prices'))
-    return render_template('admin/price_import_pdf.html')
+        return _start_import_job(f, 'pdf', 'platform')
+    return render_template('admin/price_import_pdf.html', cache_stats=parse_cache_stats())
 
 
 @app.route('/admin/price/import-image', methods=['GET', 'POST'])
@@ -3063,37 +4816,215 @@ def admin_price_import_image():
         if ext not in SITE_IMAGE_EXT:
             flash('请上传图片（jpg/png/gif/webp）')
             return redirect(url_for('admin_price_import_image'))
-        import tempfile
-        path = os.path.join(tempfile.gettempdir(), f"price_img_{int(datetime.utcnow().timestamp())}{ext}")
-        f.save(path)
+        return _start_import_job(f, 'image', 'platform')
+    return render_template('admin/price_import_image.html', cache_stats=parse_cache_stats())
+
+
+# ---------- 批量导入（zip / 多文件）----------
+# 一次上传 zip 或多个 PDF/图片：每个文件一个识别任务，由识别进程池并行解析；全部完成后合并去重，
+# 生成一份导入预览，确认后在同一事务里写入。文件名含游戏关键字时以文件名为准（同 import_prices_from_pdfs.py）。
+GAME_FILENAME_KEYWORDS = (('原神', '原神'), ('星穹铁道', '星铁'), ('星铁', '星铁'), ('鸣潮', '鸣潮'),
+                          ('明日方舟', '终末地'), ('终末地', '终末地'), ('三角洲', '三角洲'), ('永劫无间', '永劫无间'))
+BULK_IMPORT_MAX_FILES = 30
+BULK_IMPORT_MAX_BYTES = 200 * 1024 * 1024  # zip 解压后总大小上限
+
+
+def infer_game_from_filename(filename):
+    """按文件名推断游戏（如 星穹铁道代肝价格表.pdf -> 星铁），推断不出返回 None。"""
+    name = os.path.basename(filename or '')
+    return next((game for keyword, game in GAME_FILENAME_KEYWORDS if keyword in name), None)
+
+
+def _bulk_import_kind(filename):
+    ext = os.path.splitext(filename or '')[1].lower()
+    if ext == '.pdf':
+        return 'pdf'
+    return 'image' if ext in SITE_IMAGE_EXT else None
+
+
+def _zip_entry_name(info):
+    """zip 内文件名：未标记 UTF-8 的按 GBK 解码（Windows 自带压缩的中文文件名）。"""
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        return info.filename.encode('cp437').decode('gbk')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return info.filename
+
+
+def _expand_bulk_upload(storages):
+    """展开上传的文件（zip 解出其中的 PDF/图片），返回 ([(kind, FileStorage), ...], 跳过的文件名列表)。
+    可识别文件超过 BULK_IMPORT_MAX_FILES 个、zip 解压后总大小超过 BULK_IMPORT_MAX_BYTES 时抛 ValueError（超限即停，不再往下解压）。
+    损坏（CRC 不符）、加密或压缩方式不支持的 zip 条目计入跳过列表。"""
+    files, skipped, total = [], [], 0
+
+    def check_file_count():
+        if len(files) >= BULK_IMPORT_MAX_FILES:
+            raise ValueError(f'一次最多导入 {BULK_IMPORT_MAX_FILES} 个文件，请分批上传')
+
+    for fs in storages:
+        if not fs or not fs.filename:
+            continue
+        if not fs.filename.lower().endswith('.zip'):
+            kind = _bulk_import_kind(fs.filename)
+            if kind:
+                check_file_count()
+                files.append((kind, fs))
+            else:
+                skipped.append(fs.filename)
+            continue
         try:
-            rows, err = _parse_image_prices(path)
-            if err:
-                flash('识别失败：' + err)
-                return redirect(url_for('admin_price_import_image'))
-            if not rows:
-                flash('未能从图片中识别出有效价格行，请确保图片清晰且包含「游戏/任务类型/价格」')
-                return redirect(url_for('admin_price_import_image'))
-            added, updated = 0, 0
-            for game, task_type, price, unit in rows:
-                p = _find_platform_price_fuzzy(game, task_type)
-                if p:
-                    p.price = price
-                    p.unit = unit or p.unit
-                    updated += 1
-                else:
-                    db.session.add(Price(game=game.strip()[:50], task_type=task_type.strip()[:50], price=price, unit=unit or '元/次'))
-                    added += 1
-            db.session.commit()
-            flash(f'图片识别导入成功：识别 {len(rows)} 条，新增 {added} 条，更新 {updated} 条（已做模糊匹配合并）')
-        finally:
-            if os.path.exists(path):
+            zf = zipfile.ZipFile(fs.stream)
+        except zipfile.BadZipFile:
+            skipped.append(fs.filename)
+            continue
+        with zf:
+            for info in zf.infolist():
+                name = _zip_entry_name(info)
+                base = os.path.basename(name)
+                if info.is_dir() or name.startswith('__MACOSX/') or not base or base.startswith('.'):
+                    continue
+                kind = _bulk_import_kind(base)
+                if not kind:
+                    skipped.append(base)
+                    continue
+                total += info.file_size
+                if total > BULK_IMPORT_MAX_BYTES:
+                    raise ValueError(f'压缩包解压后超过 {BULK_IMPORT_MAX_BYTES // 1024 // 1024} MB，请分批上传')
+                check_file_count()
                 try:
-                    os.remove(path)
-                except OSError:
-                    pass
-        return redirect(url_for('admin_prices'))
-    return render_template('admin/price_import_image.html')
+                    data = zf.read(info)
+                except (zipfile.BadZipFile, zlib.error, EOFError, RuntimeError, NotImplementedError):
+                    # CRC 不符/数据截断、加密条目、不支持的压缩方式
+                    skipped.append(base)
+                    continue
+                files.append((kind, FileStorage(stream=io.BytesIO(data), filename=base)))
+    return files, skipped
+
+
+def merge_import_batch_rows(jobs):
+    """合并同一批各文件的识别结果：文件名推断出游戏的以文件名为准；
+    多个文件出现同一 (游戏, 任务类型) 时只保留一行，价格以后上传的文件为准。"""
+    merged = {}
+    for job in jobs:
+        if job.status != 'done' or not job.rows:
+            continue
+        file_game = infer_game_from_filename(job.filename)
+        for game, task_type, price, unit in json.loads(job.rows):
+            game = file_game or game
+            merged[(game, task_type)] = (game, task_type, price, unit)
+    return list(merged.values())
+
+
+def _get_import_batch(batch):
+    jobs = ImportJob.query.filter_by(batch=batch, purpose='platform').order_by(ImportJob.id).all()
+    if not jobs:
+        abort(404)
+    return jobs
+
+
+@app.route('/admin/price/import-bulk', methods=['GET', 'POST'])
+@login_required
+def admin_price_import_bulk():
+    """批量导入价格表：上传 zip 或多个 PDF/图片，后台并行识别后合并成一份导入预览。"""
+    if current_user.role != 'admin':
+        return redirect(url_for('player_dashboard'))
+    if request.method == 'POST':
+        try:
+            files, skipped = _expand_bulk_upload(request.files.getlist('files'))
+        except ValueError as e:
+            flash(str(e))
+            return redirect(url_for('admin_price_import_bulk'))
+        if not files:
+            flash('未找到可识别的 PDF 或图片文件')
+            return redirect(url_for('admin_price_import_bulk'))
+        batch = secrets.token_hex(8)
+        for kind, fs in files:
+            create_import_job(fs, kind, 'platform', batch=batch)
+        db.session.commit()
+        wake_import_worker()
+        if skipped:
+            flash('已跳过不支持的文件：' + '、'.join(skipped[:10]) + (' 等' if len(skipped) > 10 else ''))
+        return redirect(url_for('admin_price_import_batch', batch=batch))
+    return render_template('admin/price_import_bulk.html', cache_stats=parse_cache_stats(),
+                           max_files=BULK_IMPORT_MAX_FILES)
+
+
+@app.route('/admin/price/import-bulk/<batch>')
+@login_required
+def admin_price_import_batch(batch):
+    """批量导入进度页：逐个文件显示识别状态，全部结束后可生成合并预览。"""
+    if current_user.role != 'admin':
+        return redirect(url_for('player_dashboard'))
+    jobs = _get_import_batch(batch)
+    finished = all(j.status in ('done', 'failed') for j in jobs)
+    return render_template('admin/price_import_batch.html', batch=batch, jobs=jobs, finished=finished,
+                           games={j.id: infer_game_from_filename(j.filename) for j in jobs},
+                           row_counts={j.id: len(json.loads(j.rows)) if j.rows else 0 for j in jobs})
+
+
+@app.route('/admin/price/import-bulk/<batch>/status')
+@login_required
+def admin_price_import_batch_status(batch):
+    if current_user.role != 'admin':
+        abort(403)
+    jobs = _get_import_batch(batch)
+    return jsonify({
+        'finished': all(j.status in ('done', 'failed') for j in jobs),
+        'jobs': [{'id': j.id, 'status': j.status, 'pages_done': j.pages_done or 0, 'pages_total': j.pages_total}
+                 for j in jobs],
+    })
+
+
+@app.route('/admin/price/import-bulk/<batch>/preview', methods=['POST'])
+@login_required
+def admin_price_import_batch_preview(batch):
+    """合并同批识别结果，与价格表比对生成一份导入预览，确认后由 admin_price_import_confirm 一次写入。"""
+    if current_user.role != 'admin':
+        return redirect(url_for('player_dashboard'))
+    jobs = _get_import_batch(batch)
+    if any(j.status in ('queued', 'running') for j in jobs):
+        flash('还有文件在识别中，请稍候')
+        return redirect(url_for('admin_price_import_batch', batch=batch))
+    rows = merge_import_batch_rows(jobs)
+    if not rows:
+        flash('没有识别成功的文件，请检查后重新上传')
+        return redirect(url_for('admin_price_import_bulk'))
+    done = sum(1 for j in jobs if j.status == 'done')
+    return _render_price_import_preview('bulk', f'批量导入 {done} 个文件', rows)
+
+
+@app.route('/admin/price/import/confirm', methods=['POST'])
+@login_required
+def admin_price_import_confirm():
+    """确认导入预览：价格表未被改动则批量写入，否则按最新价格表重新比对后再次预览。"""
+    if current_user.role != 'admin':
+        return redirect(url_for('player_dashboard'))
+    token = request.form.get('token', '')
+    draft = _load_price_import_draft(token)
+    back = PRICE_IMPORT_UPLOAD_ENDPOINTS.get((draft or {}).get('source'), 'admin_price_import_pdf')
+    if not draft:
+        flash('导入预览已失效，请重新上传')
+        return redirect(url_for(back))
+    plan = draft['plan']
+    if not apply_price_import_plan(plan, draft['version']):
+        db.session.rollback()
+        _discard_price_import_draft(token)
+        rows = [tuple(r) for r in draft['rows']]
+        return _render_price_import_preview(draft['source'], draft['filename'], rows,
+                                            notice='预览后价格表已被修改，已按最新价格表重新比对，请再次确认')
+    added = sum(1 for x in plan if x['action'] == 'insert')
+    updated = sum(1 for x in plan if x['action'] == 'update')
+    db.session.add(Log(
+        user_id=current_user.id,
+        action='import_price',
+        target_type='price',
+        detail=f'导入价格表（{draft["filename"]}）：解析 {len(draft["rows"])} 条，新增 {added} 条，更新 {updated} 条'
+    ))
+    db.session.commit()
+    _discard_price_import_draft(token)
+    flash(f'导入成功：解析 {len(draft["rows"])} 条，新增 {added} 条，更新 {updated} 条（已做模糊匹配合并）')
+    return redirect(url_for('admin_prices'))
 
 
 @app.route('/admin/price/edit/<int:price_id>', methods=['GET', 'POST'])
@@ -3119,6 +5050,7 @@ def edit_prices(price_id):
             detail=f'修改价格（ID:{price_id}）原:{old_detail} 新:游戏:{price.game} 类型:{price.task_type} 价格:{price.price}'
         )
         db.session.add(log)
+        bump_price_catalog_version()
         db.session.commit()
         flash('价格更新成功')
         st = request.form.get('service_type', '代肝')
@@ -3150,6 +5082,7 @@ def admin_price_add():
             return redirect(url_for('admin_prices', service_type=service_type))
         p = Price(game=game, task_type=task_type, price=price_val, unit=unit or '元/次', remark=remark or None, service_type=service_type)
         db.session.add(p)
+        bump_price_catalog_version()
         db.session.commit()
         flash('价格已添加')
         return redirect(url_for('admin_prices', service_type=service_type))
@@ -3198,6 +5131,7 @@ def admin_task_request_approve(req_id):
         db.session.add(PlayerPrice(player_id=req.player_id, game=req.game, task_type=req.task_type, price=req.player_price))
     req.status = '已通过'
     req.reviewed_at = datetime.utcnow()
+    bump_price_catalog_version()
     db.session.commit()
     flash(f'已通过：{req.game} - {req.task_type}，已写入该打手报价 ￥{req.player_price:.2f}，平台价 ￥{platform_price:.2f}。您可在此修改平台价，后续按正常规则派单。')
     return redirect(url_for('edit_prices', price_id=p.id))
@@ -3229,12 +5163,7 @@ def index():
         else:
             return redirect(url_for('player_dashboard'))
     # 未登录：展示业务首页，并传入价格数据
-    prices = Price.query.order_by(Price.game, Price.task_type).all()
-    grouped_prices = {}
-    for p in prices:
-        if p.game not in grouped_prices:
-            grouped_prices[p.game] = []
-        grouped_prices[p.game].append(p)
+    grouped_prices = get_price_catalog().grouped()
     member_plans = MemberPlan.query.order_by(MemberPlan.price).all()
     return render_template('home.html', grouped_prices=grouped_prices, member_plans=member_plans)
 
@@ -3304,6 +5233,7 @@ with app.app_context():
         'ALTER TABLE user ADD COLUMN equipment_photos TEXT',
         'ALTER TABLE user ADD COLUMN equipment_desc VARCHAR(500)',
         'ALTER TABLE user ADD COLUMN is_certified INTEGER DEFAULT 0',
+        'ALTER TABLE "user" ADD COLUMN income_version INTEGER DEFAULT 0',
     ]:
         try:
             with db.engine.connect() as conn:
@@ -3332,6 +5262,56 @@ with app.app_context():
                 pass
     except Exception:
         pass
+    try:
+        with db.engine.connect() as conn:
+            conn.execute(text('ALTER TABLE import_job ADD COLUMN cache_hit INTEGER DEFAULT 0'))
+            conn.commit()
+    except Exception:
+        pass
+    try:
+        with db.engine.connect() as conn:
+            conn.execute(text('ALTER TABLE import_job ADD COLUMN batch VARCHAR(32)'))
+            conn.commit()
+    except Exception:
+        pass
+    try:
+        with db.engine.connect() as conn:
+            conn.execute(text('CREATE INDEX IF NOT EXISTS ix_import_job_batch ON import_job (batch)'))
+            conn.commit()
+    except Exception:
+        pass
+    # 已有库补建订单表索引（定义见 Order.__table_args__，新库由 create_all 建出）
+    for index in Order.__table__.indexes:
+        try:
+            with db.engine.connect() as conn:
+                columns = ', '.join(c.name for c in index.columns)
+                conn.execute(text(f'CREATE INDEX IF NOT EXISTS {index.name} ON "order" ({columns})'))
+                conn.commit()
+        except Exception:
+            pass
+    # 已有库补建意向列表复合索引（新库由 create_all 建出）
+    try:
+        with db.engine.connect() as conn:
+            conn.execute(text('CREATE INDEX IF NOT EXISTS ix_custom_offer_status_game_anime '
+                              'ON custom_offer_request (status, game, is_anime_no_display)'))
+            conn.commit()
+    except Exception:
+        pass
+    # 打手擅长游戏表为空而已有打手填写 preferred_games 时（首次升级），按用户表回填
+    if not PlayerGame.query.first() and User.query.filter(
+            User.role == 'player', User.preferred_games.isnot(None)).first():
+        rebuild_player_games()
+    # 打手月度完成计数表为空而已有完成订单时（首次升级），按订单表回填
+    if not PlayerMonthlyCompletion.query.first() and Order.query.filter(
+            Order.status == '已完成', Order.player_id.isnot(None)).first():
+        rebuild_monthly_completion_counters()
+    # 打手口碑计数表为空而已有完成订单或礼物时（首次升级），按订单表与礼物表回填
+    if not PlayerStats.query.first() and (Order.query.filter(
+            Order.status == '已完成', Order.player_id.isnot(None)).first() or db.session.query(CustomerGift.id).first()):
+        check_player_stats(repair=True)
+    # 按天汇总表为空而已有订单时（首次升级），按订单表与礼物订单回填
+    if not DailyStat.query.first() and Order.query.first():
+        rebuild_daily_stats()
     if not User.query.filter_by(username='admin').first():
         admin = User(username='admin', password=generate_password_hash('yang86351294?'), role='admin')
         db.session.add(admin)
@@ -3350,6 +5330,7 @@ with app.app_context():
             ('排位代练', 15), ('日常任务', 8), ('周常', 20), ('通行证', 35), ('指定任务', 25),
         ]:
             db.session.add(Price(game='永劫无间', task_type=task_type, price=float(price), unit='元/次'))
+        bump_price_catalog_version()
     # 初始化虚拟礼物商品（如果不存在）
     if not GiftProduct.query.first():
         gifts = [
@@ -3373,6 +5354,9 @@ with app.app_context():
         db.session.add(ContactSetting(wechat='1447478012', qq='1447478012', work_time='9:00-22:00'))
     db.session.commit()
 
+# 启动即拉起进程内派单线程：重启/发版前遗留的 pending 任务和超时的 running 任务不必等下一笔支付入队才被处理
+start_dispatch_workers()
+
 @app.context_processor
 def inject_pending_approval():
     if current_user.is_authenticated and current_user.role == 'admin':
@@ -3414,7 +5398,7 @@ def inject_announcement():
 
 @app.route('/game/<string:game_name>')
 def game_prices(game_name):
-    tasks = Price.query.filter_by(game=game_name).order_by(Price.task_type).all()
+    tasks = get_price_catalog().tasks(game_name)
     if not tasks:
         return render_template('game_prices_empty.html', game=game_name)
     return render_template('game_prices.html', game=game_name, tasks=tasks)
@@ -3699,5 +5683,122 @@ def admin_site_images():
     return render_template('admin/site_images.html', image_info=image_info, site_image_keys=SITE_IMAGE_KEYS, site_image_url=site_image_url, background_slides=background_slides)
 
 
+# ---------- 命令行 ----------
+@app.cli.command('dispatch-backlog')
+def dispatch_backlog_command():
+    """批量派单：flask --app app dispatch-backlog"""
+    assigned, total, profit = batch_dispatch_orders()
+    print(f'待分配 {total} 单，已分配 {assigned} 单，平台利润 {profit:.2f}')
+
+
+
+@app.cli.command('dispatch-worker')
+def dispatch_worker_command():
+    """以独立进程运行派单 worker（配合 DISPATCH_WORKER_THREADS=0 使用，生产环境推荐方式）：flask --app app dispatch-worker
+    启动后先处理积压的 pending 任务和超时的 running 任务，再等待新任务。"""
+    print('派单 worker 已启动，Ctrl+C 退出')
+    run_dispatch_worker()
+
+
+
+@app.cli.command('import-worker')
+def import_worker_command():
+    """以独立进程运行价格表识别任务 worker（配合 IMPORT_WORKER_THREADS=0 使用）：flask --app app import-worker"""
+    print('识别任务 worker 已启动，Ctrl+C 退出')
+    run_import_worker()
+
+
+
+@app.cli.command('rebuild-completion-counters')
+def rebuild_completion_counters_command():
+    """按订单表重建打手月度完成计数：flask --app app rebuild-completion-counters"""
+    rows = rebuild_monthly_completion_counters()
+    print(f'已重建打手月度完成计数 {rows} 行')
+
+
+@app.cli.command('rebuild-daily-stats')
+def rebuild_daily_stats_command():
+    """按订单表与礼物订单重建按天汇总统计：flask --app app rebuild-daily-stats"""
+    rows = rebuild_daily_stats()
+    print(f'已重建按天汇总统计 {rows} 行')
+
+
+@app.cli.command('check-player-stats')
+@click.option('--repair', is_flag=True, help='按订单表与礼物表重算值修正计数')
+def check_player_stats_command(repair):
+    """核对打手口碑计数（完成数/评分/礼物总额）与订单表、礼物表是否一致，不一致且未修复时以非零状态退出：
+    flask --app app check-player-stats [--repair]"""
+    drift = check_player_stats(repair=repair)
+    for player_id, name, have, want in drift:
+        print(f'打手 {player_id} {name}：计数 {have}，应为 {want}')
+    if not drift:
+        print('打手口碑计数一致')
+    elif repair:
+        print(f'已修复 {len(drift)} 项')
+    else:
+        raise SystemExit(1)
+
+
+def order_query_shapes():
+    """仪表盘、打手、顾客页面的订单查询形状及期望命中的索引：[(说明, select 语句, 可接受的索引名), ...]。
+    今日卡片、本月排行与打手收入图表已改读 DailyStat，不在此列。"""
+    today_start, _ = day_range(datetime.utcnow().date())
+    month_start = today_start.replace(day=1)
+    return [
+        ('管理员订单列表：游标翻页',
+         db.select(Order.id).where(
+             Order.created_at <= today_start, db.or_(Order.created_at < today_start, Order.id < 1)
+         ).order_by(Order.created_at.desc(), Order.id.desc()).limit(ADMIN_ORDER_PAGE_SIZE + 1),
+         ('ix_order_created_at',)),
+        ('仪表盘：待处理订单',
+         db.select(Order.id).where(Order.status.in_(['待分配', '进行中', '待验收'])).order_by(Order.created_at.desc()),
+         ('ix_order_status_created', 'ix_order_status_payment_created')),
+        ('待接单大厅',
+         db.select(Order.id).where(Order.status == '待分配', Order.player_id.is_(None),
+                                   Order.payment_status == '已支付').order_by(Order.created_at.desc()),
+         ('ix_order_status_payment_created', 'ix_order_player_status_created')),
+        ('打手：我的订单',
+         db.select(Order.id).where(Order.player_id == 1).order_by(Order.created_at.desc()),
+         ('ix_order_player_created', 'ix_order_player_status_created')),
+        ('打手：收入明细',
+         db.select(Order.id).where(Order.player_id == 1, Order.status == '已完成', Order.created_at >= month_start),
+         ('ix_order_player_status_created',)),
+        ('顾客：我的订单',
+         db.select(Order.id).where(Order.customer_id == 1).order_by(Order.created_at.desc()),
+         ('ix_order_customer_created',)),
+    ]
+
+
+def explain_query(stmt):
+    """返回语句在当前数据库上的执行计划文本。SQLite 用 EXPLAIN QUERY PLAN；PostgreSQL 用 EXPLAIN，
+    并在事务内关闭顺序扫描——表小时优化器总会选顺序扫描，关掉后才看得出索引能否被用上。"""
+    compiled = stmt.compile(dialect=db.engine.dialect, compile_kwargs={'render_postcompile': True})
+    params = tuple(compiled.params[k] for k in compiled.positiontup) if compiled.positional else compiled.params
+    with db.engine.connect() as conn:
+        if db.engine.dialect.name == 'postgresql':
+            conn.exec_driver_sql('SET LOCAL enable_seqscan = off')
+            rows = conn.exec_driver_sql('EXPLAIN ' + str(compiled), params).all()
+        else:
+            rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled), params).all()
+        conn.rollback()
+    return '\n'.join(str(row[-1]) for row in rows)
+
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """用 EXPLAIN 核对订单查询是否命中索引（SQLite / PostgreSQL），有未命中的以非零状态退出：flask --app app check-indexes"""
+    missed = 0
+    for label, stmt, expected in order_query_shapes():
+        plan = explain_query(stmt)
+        used = [name for name in expected if name in plan]
+        if not used:
+            missed += 1
+        print(f'{"OK  " if used else "MISS"} {label}：{used[0] if used else "未命中索引"}')
+        if not used:
+            print('     ' + plan.replace('\n', '\n     '))
+    if missed:
+        raise SystemExit(1)
+
+
 if __name__ == '__main__':
     app.run(debug=True)
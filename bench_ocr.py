@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+OCR 基准脚本：对比价格表图片「原图直接识别」与「预处理 + 分块并行识别」的耗时和解析出的价格行数。
+运行：python bench_ocr.py [图片文件或目录 ...]（默认使用 ocr_fixtures/ 下的样例截图：普通价格表、超宽表格、需分块识别的长截图）
+需安装 pytesseract、Pillow 以及本机 Tesseract（含 chi_sim）；装有 tesserocr 时 OCR 进程池改用常驻引擎。
+"""
+import os
+import sys
+import time
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASE)
+
+FIXTURE_DIR = os.path.join(BASE, "ocr_fixtures")
+IMAGE_EXT = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+
+
+def collect_images(paths):
+    images = []
+    for p in paths:
+        if os.path.isdir(p):
+            for name in sorted(os.listdir(p)):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXT:
+                    images.append(os.path.join(p, name))
+        elif os.path.isfile(p):
+            images.append(p)
+    return images
+
+
+def run_once(appmod, path, preprocess):
+    appmod.OCR_PREPROCESS = preprocess
+    start = time.perf_counter()
+    text = appmod._ocr_image_to_text(path)
+    elapsed = time.perf_counter() - start
+    rows = appmod._parse_text_to_price_rows(text) if text else []
+    return elapsed, len(rows)
+
+
+def main():
+    images = collect_images(sys.argv[1:] or [FIXTURE_DIR])
+    if not images:
+        print("未找到图片，用法：python bench_ocr.py [图片文件或目录 ...]")
+        return
+    try:
+        import pytesseract
+        pytesseract.get_tesseract_version()
+    except Exception as e:
+        print("无法调用 Tesseract：", e)
+        return
+    from PIL import Image
+    import app as appmod
+
+    print("%-36s %-11s %10s %6s %10s %6s" % ("图片", "尺寸", "原图耗时", "行数", "预处理耗时", "行数"))
+    total_raw, total_pre = 0.0, 0.0
+    for path in images:
+        with Image.open(path) as img:
+            size = "%dx%d" % img.size
+        raw_time, raw_rows = run_once(appmod, path, False)
+        pre_time, pre_rows = run_once(appmod, path, True)
+        total_raw += raw_time
+        total_pre += pre_time
+        print("%-36s %-11s %9.2fs %6d %9.2fs %6d" % (
+            os.path.basename(path)[:36], size, raw_time, raw_rows, pre_time, pre_rows))
+    print("合计：原图 %.2fs，预处理 %.2fs（%d 张）" % (total_raw, total_pre, len(images)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+价格表文本解析回归与基准脚本：以改写前的 _parse_text_to_price_rows（原样冻结在本文件中）为对照，
+对 price_parser_fixtures/ 下保存的识别文本和随机生成的识别文本做逐行差分，再对比两者在几千行价格表上的耗时。
+运行：python bench_price_parser.py [--iterations N] [--seed S] [--lines N] [--repeat N]
+不需要 Tesseract；任一输入解析结果与旧版不一致时打印该输入并以非零状态退出。
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASE)
+
+FIXTURE_DIR = os.path.join(BASE, "price_parser_fixtures")
+
+# 随机识别文本的素材：分区标题、游戏名、表头、价格符号/单位、边界数字以及常见的识别噪声和空白字符
+ATOMS = [
+    "主线任务", "支线", "日常托管", "日常", "探索类", "探索", "基建滑索", "基建", "次要任务", "次要", "功能任务", "功能",
+    "至尊开荒", "开荒托管", "二、", "三、", "六、", "七、", "原神", "星铁", "鸣潮", "永劫无间", "三角洲", "终末地",
+    "明日方舟", "终末", "游戏", "价格", "单位", "备注", "price list", "Price", "任务类型", "¥", "￥", "元", "/", "r",
+    "R", "号", "图", "天", "月", "一月", "12", "3.5", "0", "-1", "100000", "99999", "1,200", "nan", "inf", "1e3",
+    "1_0", "１２", ".", ",", "abc", "深渊", "每日", "x", " ", "  ", "\u3000", "\t", "\xa0", "\x1c", "\x85",
+]
+
+
+# ---- 对照实现：改写前的解析函数，保持原样，不要随 app.py 修改 ----
+
+def legacy_parse_text_to_price_rows(text):
+    """从纯文本中解析价格行，返回 [(game, task_type, price, unit), ...]。
+    支持带「主线任务」「支线任务」分区的价格表，以及标题中含游戏名（如 明日方舟:终末地）。"""
+    import re
+    rows = []
+    skip_headers = ('游戏', '价格', '任务类型', '单位', '备注', 'price list')
+    lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
+    default_game = None
+    current_section = None
+    # 从标题行推断游戏名（如 明日方舟:终末地代肝价格表 -> 终末地）
+    for ln in lines[:5]:
+        if '终末地' in ln:
+            default_game = '终末地'
+            break
+        if '明日方舟' in ln and '终末地' not in ln:
+            default_game = '终末地'
+            break
+        for g in ('原神', '星铁', '鸣潮', '永劫无间', '三角洲'):
+            if g in ln:
+                default_game = g
+                break
+        if default_game:
+            break
+    for line in lines:
+        if not line or len(line) < 2:
+            continue
+        # 分区标题：主线/支线/日常托管/探索类/基建/次要/功能/开荒
+        if '主线任务' in line or (len(line) <= 8 and line.startswith('主线')):
+            current_section = '主线'
+            continue
+        if '支线任务' in line or (len(line) <= 8 and line.startswith('支线')):
+            current_section = '支线'
+            continue
+        if '日常托管' in line or '日常' == line[:2]:
+            current_section = '日常'
+            continue
+        if '探索类' in line or '探索' == line[:2]:
+            current_section = '探索'
+            continue
+        if '基建滑索' in line or '基建' in line:
+            current_section = '基建'
+            continue
+        if '次要任务' in line or (len(line) <= 8 and '次要' in line):
+            current_section = '次要'
+            continue
+        if '功能任务' in line or (len(line) <= 8 and '功能' in line):
+            current_section = '功能'
+            continue
+        if '至尊开荒' in line or '开荒托管' in line:
+            current_section = '开荒'
+            continue
+        if '二、' in line or '三、' in line or '四、' in line or '五、' in line or '六、' in line:
+            if '主线' in line:
+                current_section = '主线'
+            elif '支线' in line:
+                current_section = '支线'
+            elif '日常' in line:
+                current_section = '日常'
+            elif '探索' in line:
+                current_section = '探索'
+            elif '基建' in line:
+                current_section = '基建'
+            elif '次要' in line:
+                current_section = '次要'
+            elif '功能' in line:
+                current_section = '功能'
+            elif '开荒' in line:
+                current_section = '开荒'
+            continue
+        parts = re.split(r'\s+|[　\t]+', line)
+        parts = [p.strip() for p in parts if p.strip()]
+        if len(parts) < 2:
+            continue
+        price_val = None
+        rest = []
+        for i in range(len(parts) - 1, -1, -1):
+            s = re.sub(r'[¥￥元/rR/号图天/月]', '', parts[i]).strip()
+            s = s.replace(',', '').replace('一月', '')
+            try:
+                price_val = float(s)
+                if price_val <= 0 or price_val > 99999:
+                    continue
+                rest = parts[:i]
+                break
+            except ValueError:
+                continue
+        if price_val is None:
+            try:
+                s = re.sub(r'[¥￥元/rR/号图天/月]', '', parts[-1]).strip()
+                s = s.replace(',', '').replace('一月', '')
+                price_val = float(s)
+                if price_val > 0 and price_val <= 99999:
+                    rest = parts[:-1]
+            except (ValueError, IndexError):
+                continue
+        if price_val is None or not rest:
+            continue
+        if any(h in line for h in skip_headers) and len(rest) <= 2:
+            continue
+        task_name = ' '.join(rest)[:50] if len(rest) > 1 else (rest[0][:50] if rest else '')
+        if not task_name or not task_name.replace(' ', ''):
+            continue
+        if current_section:
+            task_type = f'{current_section}-{task_name}'
+        else:
+            task_type = task_name
+        game = default_game if default_game else (rest[0][:50] if rest else '未知')
+        if not default_game and len(rest) >= 2:
+            game, task_type = rest[0][:50], ' '.join(rest[1:])[:50]
+            if current_section:
+                task_type = f'{current_section}-{task_type}'
+        elif not default_game and len(rest) == 1:
+            game = '终末地' if '终末' in text[:200] else (rest[0][:50] if rest else '未知')
+        rows.append((game, task_type, round(price_val, 2), '元/次'))
+    return rows
+
+
+# ---- 对照实现结束 ----
+
+
+def setup_environment():
+    """在导入 app 之前指向临时数据库与上传目录，并关闭进程内派单/识别线程。返回临时目录。"""
+    tmp = tempfile.mkdtemp(prefix="bench_price_parser_")
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tmp, "bench.sqlite3")
+    os.environ["UPLOAD_FOLDER"] = os.path.join(tmp, "uploads")
+    os.environ["DISPATCH_WORKER_THREADS"] = "0"
+    os.environ["IMPORT_WORKER_THREADS"] = "0"
+    return tmp
+
+
+def load_fixtures():
+    """读取保存的识别文本，返回 [(名称, 文本), ...]；按原始字节解码，保留 CRLF 换行。"""
+    fixtures = []
+    for name in sorted(os.listdir(FIXTURE_DIR)):
+        if name.endswith(".txt"):
+            with open(os.path.join(FIXTURE_DIR, name), "rb") as f:
+                fixtures.append((name, f.read().decode("utf-8")))
+    return fixtures
+
+
+def random_text(rng):
+    """拼一段随机识别文本：约六成是「若干词 + 价格 + 单位」的价格行，其余是纯噪声行。"""
+    lines = []
+    for _ in range(rng.randint(0, 30)):
+        if rng.random() < 0.6:
+            words = " ".join("".join(rng.choice(ATOMS) for _ in range(rng.randint(1, 3)))
+                             for _ in range(rng.randint(1, 4)))
+            price = rng.choice([rng.randint(0, 200), round(rng.uniform(0, 99), 3), 100000])
+            lines.append("%s %s%s%s" % (words, rng.choice(["", "¥", "￥"]), price,
+                                        rng.choice(["", "元", "/次", "元/小时", "月", "r"])))
+        else:
+            lines.append("".join(rng.choice(ATOMS) for _ in range(rng.randint(0, 8))))
+    return rng.choice(["\n", "\r\n", "\n\n"]).join(lines)
+
+
+def benchmark_sheet(count):
+    """几千行的终末地价格表：标题行 + 主线/支线两个分区，每个分区 count 行。"""
+    sheet = ["明日方舟:终末地代肝价格表", "一、主线任务"]
+    sheet += ["第%d章 剧情 %d元" % (i, i % 90 + 5) for i in range(count)]
+    sheet += ["二、支线任务"]
+    sheet += ["支线%d 委托 ￥%d/次" % (i, i % 50 + 1) for i in range(count)]
+    return "\n".join(sheet)
+
+
+def compare(name, text, parse):
+    """新旧解析结果逐项比较（含浮点价格的 repr），不一致时打印差异并返回 False。"""
+    expected = legacy_parse_text_to_price_rows(text)
+    actual = parse(text)
+    if repr(expected) == repr(actual):
+        return True
+    print("不一致：%s" % name)
+    shown = repr(text)
+    print("  输入：%s" % (shown if len(shown) <= 2000 else shown[:2000] + " …（共 %d 字符）" % len(text)))
+    print("  旧版：%r" % (expected,))
+    print("  新版：%r" % (actual,))
+    return False
+
+
+def time_parse(parse, text, repeat):
+    parse(text)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        parse(text)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="价格表文本解析回归与基准")
+    parser.add_argument("--iterations", type=int, default=20000, help="随机差分的样本数")
+    parser.add_argument("--seed", type=int, default=7, help="随机差分的种子，便于复现")
+    parser.add_argument("--lines", type=int, default=2000, help="基准价格表每个分区的行数")
+    parser.add_argument("--repeat", type=int, default=20, help="基准重复次数")
+    args = parser.parse_args()
+
+    tmp = setup_environment()
+    try:
+        import app as appmod
+        parse = appmod._parse_text_to_price_rows
+        failed = 0
+
+        fixtures = load_fixtures()
+        for name, text in fixtures:
+            if compare(name, text, parse):
+                print("%-28s %4d 行 一致" % (name, len(parse(text))))
+            else:
+                failed += 1
+
+        rng = random.Random(args.seed)
+        rows = checked = 0
+        for i in range(args.iterations):
+            checked += 1
+            text = random_text(rng)
+            if not compare("随机样本 #%d（seed=%d）" % (i, args.seed), text, parse):
+                failed += 1
+                break
+            rows += len(parse(text))
+        print("随机差分：%d 个样本，共 %d 行价格" % (checked, rows))
+
+        text = benchmark_sheet(args.lines)
+        if not compare("基准价格表", text, parse):
+            failed += 1
+        old_ms = time_parse(legacy_parse_text_to_price_rows, text, args.repeat)
+        new_ms = time_parse(parse, text, args.repeat)
+        print("基准（%d 行）：旧版 %.2f ms，新版 %.2f ms，加速 %.1fx" % (
+            len(text.splitlines()), old_ms, new_ms, old_ms / new_ms if new_ms else 0))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if failed:
+        print("有 %d 处与旧版不一致" % failed)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
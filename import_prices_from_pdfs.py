@@ -3,11 +3,20 @@
 从项目目录下的 PDF 价格表导入到数据库。
 PDF 为纯文本格式（无表格），价格格式如 40r、50r/号、140/图 等。
 游戏名从文件名推断：原神、星铁、鸣潮、终末地 等。
-运行：在项目目录下执行  python import_prices_from_pdfs.py
+运行：在项目目录下执行  python import_prices_from_pdfs.py [目录] [--dry-run] [--json] [--force] [--workers N]
+
+增量导入：清单文件（默认 instance/price_import_manifest.json）记录每个 PDF 上次导入时的 SHA-256，
+内容没变的文件直接跳过；有变化的文件多进程并行解析，所有行与价格表比对后一次批量写入，价格没变的行不写。
+适合放在定时任务里跑，设计同学放入新价格表后只会导入改动的部分。
 """
+import argparse
+import hashlib
+import json
 import os
 import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 
 BASE = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, BASE)
@@ -27,6 +36,10 @@ GAME_FROM_FILENAME = {
     "永劫无间代练价格表.pdf": "永劫无间",
 }
 
+# 解析规则有改动时递增，清单里旧版本解析的文件会被重新导入
+PARSER_VERSION = "text-1"
+DEFAULT_MANIFEST = os.path.join(BASE, "instance", "price_import_manifest.json")
+
 
 def parse_text_prices(text, game_name):
     rows = []
@@ -73,42 +86,168 @@ def extract_text_from_pdf(pdf_path):
     return "\n".join(text_parts)
 
 
-def main():
-    from app import app, db
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def parse_pdf_file(path, game):
+    """在解析进程中执行，返回 (rows, error)。"""
+    try:
+        return parse_text_prices(extract_text_from_pdf(path), game), None
+    except Exception as e:
+        return [], str(e)
+
+
+def load_manifest(path):
+    try:
+        with open(path, encoding="utf-8") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(path, manifest):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as fp:
+        json.dump(manifest, fp, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def scan_files(directory, manifest, force=False):
+    """按 GAME_FROM_FILENAME 找目录下的 PDF，返回 [{'file', 'game', 'path', 'sha256', 'status'}, ...]。
+    status：missing 不存在 / unchanged 与清单一致跳过 / changed 需要解析。"""
+    files = []
+    for filename, game in GAME_FROM_FILENAME.items():
+        path = os.path.join(directory, filename)
+        item = {"file": filename, "game": game, "path": path, "sha256": None, "status": "missing"}
+        if os.path.isfile(path):
+            item["sha256"] = file_sha256(path)
+            seen = manifest.get(filename) or {}
+            unchanged = seen.get("sha256") == item["sha256"] and seen.get("parser") == PARSER_VERSION
+            item["status"] = "unchanged" if unchanged and not force else "changed"
+        files.append(item)
+    return files
+
+
+def parse_changed_files(files, workers):
+    """并行解析 status=changed 的文件，结果写回 item 的 rows / error。"""
+    todo = [f for f in files if f["status"] == "changed"]
+    if not todo:
+        return
+    if workers <= 1 or len(todo) == 1:
+        results = [parse_pdf_file(f["path"], f["game"]) for f in todo]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(todo))) as pool:
+            results = list(pool.map(parse_pdf_file, [f["path"] for f in todo], [f["game"] for f in todo]))
+    for f, (rows, error) in zip(todo, results):
+        f["rows"], f["error"] = rows, error
+        if error:
+            f["status"] = "error"
+
+
+def plan_upsert(rows, existing):
+    """rows: [(game, task_type, price), ...]，同一 (game, task_type) 以最后一行为准（与逐行写库一致）；
+    existing: {(game, task_type): (id, price)}。返回 (inserts, updates, unchanged 条数)。"""
+    latest = {}
+    for game, task_type, price in rows:
+        latest[(game, task_type)] = price
+    inserts, updates, unchanged = [], [], 0
+    for (game, task_type), price in latest.items():
+        old = existing.get((game, task_type))
+        if old is None:
+            inserts.append({"game": game, "task_type": task_type, "price": price, "unit": "元/次"})
+        elif old[1] != price:
+            updates.append({"id": old[0], "price": price})
+        else:
+            unchanged += 1
+    return inserts, updates, unchanged
+
+
+def run_import(directory, manifest_path, dry_run=False, force=False, workers=None):
+    """执行一次增量导入，返回报告 dict。"""
+    from app import app, db, bump_price_catalog_version
     from models import Price
 
+    manifest = load_manifest(manifest_path)
+    files = scan_files(directory, manifest, force=force)
+    parse_changed_files(files, workers if workers is not None else (os.cpu_count() or 1))
+    parsed = [f for f in files if f["status"] == "changed"]
+    all_rows = [row for f in parsed for row in f["rows"]]
+
     with app.app_context():
-        all_rows = []
-        for filename, game in GAME_FROM_FILENAME.items():
-            path = os.path.join(BASE, filename)
-            if not os.path.isfile(path):
-                print("跳过（不存在）:", filename)
-                continue
-            print("处理:", filename, "-> 游戏:", game)
-            try:
-                text = extract_text_from_pdf(path)
-                rows = parse_text_prices(text, game)
-                all_rows.extend(rows)
-                print("  解析到", len(rows), "条")
-            except Exception as e:
-                print("  错误:", e)
-
-        if not all_rows:
-            print("未解析到任何价格，请检查 PDF 格式。")
-            return
-
-        added, updated = 0, 0
-        for game, task_type, price in all_rows:
-            p = Price.query.filter_by(game=game, task_type=task_type).first()
-            if p:
-                p.price = price
-                updated += 1
-            else:
-                db.session.add(Price(game=game, task_type=task_type, price=price, unit="元/次"))
-                added += 1
-        db.session.commit()
-        print("导入完成：新增", added, "条，更新", updated, "条。")
+        games = sorted({row[0] for row in all_rows})
+        existing = {}
+        if games:
+            q = db.session.query(Price.id, Price.game, Price.task_type, Price.price).filter(
+                Price.game.in_(games)).order_by(Price.id)
+            for pid, game, task_type, price in q:
+                existing.setdefault((game, task_type), (pid, price))
+        inserts, updates, unchanged = plan_upsert(all_rows, existing)
+        if not dry_run:
+            if updates:
+                db.session.bulk_update_mappings(Price, updates)
+            if inserts:
+                db.session.bulk_insert_mappings(Price, inserts)
+            if updates or inserts:
+                bump_price_catalog_version()
+            db.session.commit()
+            now = datetime.utcnow().isoformat(timespec="seconds")
+            for f in parsed:
+                manifest[f["file"]] = {"sha256": f["sha256"], "game": f["game"], "parser": PARSER_VERSION,
+                                       "rows": len(f["rows"]), "imported_at": now}
+            if parsed:
+                save_manifest(manifest_path, manifest)
+        else:
+            db.session.rollback()
+
+    return {
+        "dry_run": dry_run,
+        "files": [{"file": f["file"], "game": f["game"], "status": f["status"],
+                   "rows": len(f.get("rows") or []), "error": f.get("error")} for f in files],
+        "added": len(inserts),
+        "updated": len(updates),
+        "unchanged": unchanged,
+    }
+
+
+def print_report(report):
+    labels = {"missing": "跳过（不存在）", "unchanged": "跳过（未改动）", "changed": "解析", "error": "错误"}
+    for f in report["files"]:
+        line = "%s: %s -> 游戏: %s" % (labels[f["status"]], f["file"], f["game"])
+        if f["status"] == "changed":
+            line += "，解析到 %d 条" % f["rows"]
+        elif f["status"] == "error":
+            line += "，" + (f["error"] or "")
+        print(line)
+    if not any(f["status"] == "changed" for f in report["files"]):
+        print("没有需要导入的价格表。")
+        return
+    prefix = "（试运行，未写入）" if report["dry_run"] else "导入完成："
+    print("%s新增 %d 条，更新 %d 条，未变 %d 条。" % (prefix, report["added"], report["updated"], report["unchanged"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="增量导入 PDF 价格表到价格库")
+    parser.add_argument("directory", nargs="?", default=BASE, help="PDF 所在目录（默认项目目录）")
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST, help="文件哈希清单路径")
+    parser.add_argument("--workers", type=int, default=None, help="解析进程数（默认 CPU 核数）")
+    parser.add_argument("--force", action="store_true", help="忽略清单，重新解析全部文件")
+    parser.add_argument("--dry-run", action="store_true", help="只统计将新增/更新的条数，不写库也不更新清单")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出报告")
+    args = parser.parse_args(argv)
+
+    report = run_import(args.directory, args.manifest, dry_run=args.dry_run, force=args.force, workers=args.workers)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+    return 1 if any(f["status"] == "error" for f in report["files"]) else 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
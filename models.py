@@ -14,6 +14,7 @@ class User(UserMixin, db.Model):
     registered_at = db.Column(db.DateTime, default=datetime.utcnow)  # 可选，记录注册时间
     income_mode = db.Column(db.String(20), default='percentage')
     tiered_rates = db.Column(db.Text, nullable=True)
+    income_version = db.Column(db.Integer, default=0)  # 收益规则版本号，资料保存时递增（用于计价缓存失效）
     allow_custom_price = db.Column(db.Boolean, default=False)
     phone = db.Column(db.String(20), nullable=True)
     wechat = db.Column(db.String(50), nullable=True)
@@ -55,6 +56,17 @@ class Order(db.Model):
     service_type = db.Column(db.String(20), default='代肝')  # 代肝 / 陪玩
     duration_hours = db.Column(db.Float, nullable=True)  # 陪玩订单可选：时长（小时）
 
+    # 对应仪表盘（按下单时间范围、状态）、打手（player_id + 状态 + 时间）、顾客（customer_id + 时间）、
+    # 待接单大厅（状态 + 支付状态 + 时间）几类查询；flask check-indexes 用 EXPLAIN 核对是否命中
+    __table_args__ = (
+        db.Index('ix_order_created_at', 'created_at'),
+        db.Index('ix_order_status_created', 'status', 'created_at'),
+        db.Index('ix_order_status_payment_created', 'status', 'payment_status', 'created_at'),
+        db.Index('ix_order_player_created', 'player_id', 'created_at'),
+        db.Index('ix_order_player_status_created', 'player_id', 'status', 'created_at'),
+        db.Index('ix_order_customer_created', 'customer_id', 'created_at'),
+    )
+
 class Feedback(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
@@ -289,6 +301,9 @@ class CustomOfferRequest(db.Model):
     player = db.relationship('User', backref='custom_offer_claims')
     order = db.relationship('Order', backref='custom_offer_request', foreign_keys=[order_id])
 
+    # 可接意向列表/二次元意向推送按 (status, game, is_anime_no_display) 过滤
+    __table_args__ = (db.Index('ix_custom_offer_status_game_anime', 'status', 'game', 'is_anime_no_display'),)
+
 
 class PendingTaskRequest(db.Model):
     """打手申请新增任务类型：提交后由管理员审核，通过后加入平台价格表并按抽成规则设平台价。"""
@@ -367,3 +382,131 @@ class Faq(db.Model):
     answer = db.Column(db.Text, nullable=False)
     sort_order = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class DispatchJob(db.Model):
+    """派单队列：订单支付后入队，由派单 worker（进程内线程或独立进程）异步分配打手"""
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
+    status = db.Column(db.String(20), default='pending', index=True)  # pending, running, done, failed
+    attempts = db.Column(db.Integer, default=0)  # 已尝试次数（冲突重试）
+    assigned = db.Column(db.Boolean, nullable=True)  # 是否成功分配到打手
+    error = db.Column(db.Text, nullable=True)
+    duration_ms = db.Column(db.Float, nullable=True)  # 本次派单耗时（毫秒）
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    order = db.relationship('Order', foreign_keys=[order_id])
+
+
+class DispatchBatch(db.Model):
+    """批量派单请求：管理员提交后由派单 worker 在后台求解全局指派（积压订单多时耗时较长，不在 web 请求里做）"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # 提交的管理员
+    status = db.Column(db.String(20), default='pending', index=True)  # pending, running, done, failed
+    total = db.Column(db.Integer, nullable=True)  # 待分配订单数
+    assigned = db.Column(db.Integer, nullable=True)  # 已分配订单数
+    profit = db.Column(db.Float, nullable=True)  # 平台总利润
+    error = db.Column(db.Text, nullable=True)
+    duration_ms = db.Column(db.Float, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+class PlayerMonthlyCompletion(db.Model):
+    """打手每月已完成订单数（按订单创建月份计），阶梯抽成按此查档；订单完成/撤销完成时同一事务内增减"""
+    id = db.Column(db.Integer, primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    month = db.Column(db.String(7), nullable=False)  # 'YYYY-MM'
+    completed_count = db.Column(db.Integer, default=0, nullable=False)
+
+    __table_args__ = (db.UniqueConstraint('player_id', 'month', name='unique_player_month'),)
+
+
+class DailyStat(db.Model):
+    """按天汇总的订单统计（订单按下单日期、礼物按支付日期计），订单/礼物状态变更时同一事务内增减；
+    仪表盘卡片、打手排行与打手收入图表读此表。未分配打手记 player_id=0，游戏/服务类型为空记 ''"""
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    game = db.Column(db.String(50), nullable=False, default='')
+    service_type = db.Column(db.String(20), nullable=False, default='')
+    player_id = db.Column(db.Integer, nullable=False, default=0)
+    order_count = db.Column(db.Integer, default=0, nullable=False)
+    completed_count = db.Column(db.Integer, default=0, nullable=False)
+    customer_revenue = db.Column(db.Float, default=0, nullable=False)  # 已完成订单的顾客价
+    player_payout = db.Column(db.Float, default=0, nullable=False)  # 已完成订单的打手报酬
+    gift_amount = db.Column(db.Float, default=0, nullable=False)  # 已支付礼物金额
+
+    __table_args__ = (
+        db.UniqueConstraint('day', 'game', 'service_type', 'player_id', name='unique_daily_stat'),
+        db.Index('ix_daily_stat_player_day', 'player_id', 'day'),
+    )
+
+
+class PlayerStats(db.Model):
+    """打手口碑计数：已完成订单数、评分总和/评分数（只计已完成订单）、收到礼物总额；
+    订单完成/撤销完成、顾客评价、礼物支付时同一事务内原子增减，flask check-player-stats 核对修复"""
+    id = db.Column(db.Integer, primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True)
+    completed_count = db.Column(db.Integer, default=0, nullable=False)
+    rating_sum = db.Column(db.Integer, default=0, nullable=False)
+    rating_count = db.Column(db.Integer, default=0, nullable=False)
+    gift_total = db.Column(db.Float, default=0, nullable=False)
+
+    @property
+    def avg_rating(self):
+        return round(self.rating_sum / self.rating_count, 1) if self.rating_count else None
+
+
+class PlayerGame(db.Model):
+    """打手擅长游戏（由 User.preferred_games 拆分规范化），用于二次元意向按游戏路由"""
+    id = db.Column(db.Integer, primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    game = db.Column(db.String(50), nullable=False, index=True)
+
+    __table_args__ = (db.UniqueConstraint('player_id', 'game', name='unique_player_game'),)
+
+
+class SiteCounter(db.Model):
+    """全站版本号/计数器（如价格目录版本 price_catalog），各 worker 据此判断进程内缓存是否过期"""
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, default=0, nullable=False)
+
+
+class ImportJob(db.Model):
+    """价格表识别任务：上传 PDF/图片后入队，由后台进程池解析并逐页回写进度；解析结果存于 rows 供核对后使用"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)  # pdf / image
+    purpose = db.Column(db.String(20), nullable=False)  # platform 平台价格表 / player 打手报价
+    filename = db.Column(db.String(200))
+    file_path = db.Column(db.String(500))
+    status = db.Column(db.String(20), default='queued', index=True)  # queued, running, done, failed
+    pages_done = db.Column(db.Integer, default=0)
+    pages_total = db.Column(db.Integer, nullable=True)
+    rows = db.Column(db.Text, nullable=True)  # JSON: [[game, task_type, price, unit], ...]
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    cache_hit = db.Column(db.Boolean, default=False)  # 是否命中解析缓存（未重新解析）
+    batch = db.Column(db.String(32), nullable=True, index=True)  # 批量导入批次号，同一批的文件合并成一份导入预览
+
+    user = db.relationship('User', foreign_keys=[user_id])
+
+
+class ParseCache(db.Model):
+    """价格表解析缓存：按文件内容 SHA-256 + 解析器版本保存解析结果，按 last_used_at 做 LRU 淘汰"""
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.String(64), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)  # pdf / image
+    parser_version = db.Column(db.String(20), nullable=False)
+    rows = db.Column(db.Text, nullable=False)  # JSON: [[game, task_type, price, unit], ...]
+    size_bytes = db.Column(db.Integer, default=0)
+    hits = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    __table_args__ = (db.UniqueConstraint('digest', 'kind', 'parser_version', name='unique_parse_cache'),)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+接单并发压测：N 个打手线程同时抢 M 个待分配订单和 M 个报价意向，
+校验条件更新（compare-and-set）认领：每单/每个意向恰好一人接到，顾客通知恰好各写一条。
+运行：python stress_claims.py [--threads N] [--orders M] [--rounds R] [--database-url URL]
+默认在临时 SQLite 库中运行；用 --database-url 指向一个可清空的 PostgreSQL 测试库，切勿指向生产库。
+校验不通过时以非零状态退出。
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASE)
+
+PASSWORD = "stress-pw"
+
+
+def setup_environment(database_url):
+    """在导入 app 之前设置数据库与上传目录，并关闭进程内派单/识别线程。返回临时目录。"""
+    tmp = tempfile.mkdtemp(prefix="stress_claims_")
+    os.environ["DATABASE_URL"] = database_url or "sqlite:///" + os.path.join(tmp, "stress.sqlite3")
+    os.environ["UPLOAD_FOLDER"] = os.path.join(tmp, "uploads")
+    os.environ["DISPATCH_WORKER_THREADS"] = "0"
+    os.environ["IMPORT_WORKER_THREADS"] = "0"
+    return tmp
+
+
+def seed(appmod, round_no, threads, count):
+    """建打手、顾客、待分配订单和待接单意向，返回 (打手用户名, 订单 id, 意向 id)。"""
+    from werkzeug.security import generate_password_hash
+    from models import db, User, Customer, Order, CustomOfferRequest
+
+    tag = "stress%d" % round_no
+    password = generate_password_hash(PASSWORD)
+    usernames = ["%s_p%d" % (tag, i) for i in range(threads)]
+    db.session.add_all([
+        User(username=name, password=password, role="player", player_name=name, is_approved=True)
+        for name in usernames
+    ])
+    customer = Customer(phone="1%010d" % (round_no * 100000 + 1), name=tag)
+    db.session.add(customer)
+    db.session.flush()
+    orders = [Order(order_no="%s_o%d" % (tag, i), game="原神", task_type="压测", customer_price=100,
+                    player_price=0, status="待分配", payment_status="已支付", customer_id=customer.id)
+              for i in range(count)]
+    requests = [CustomOfferRequest(request_no="%s_r%d" % (tag, i), customer_id=customer.id, game="原神",
+                                   task_type="压测", offered_price=100, status="待接单")
+                for i in range(count)]
+    db.session.add_all(orders + requests)
+    db.session.commit()
+    return usernames, [o.id for o in orders], [r.id for r in requests], customer.id
+
+
+def race(appmod, usernames, order_ids, request_ids):
+    """每个打手线程用各自的会话登录后，在同一时刻起跑，以随机顺序抢全部订单和意向。
+    返回 {('order'|'request', id): [抢到的用户名, ...]} 与异常列表。"""
+    app = appmod.app
+    targets = [("order", "/player/claim_order/%d" % i, i) for i in order_ids]
+    targets += [("request", "/player/claim_request/%d" % i, i) for i in request_ids]
+    winners = {(kind, i): [] for kind, _, i in targets}
+    errors = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(len(usernames))
+    with app.test_request_context():
+        # 认领成功跳转打手首页，失败跳回可接订单列表
+        success_path = appmod.url_for("player_dashboard")
+
+    def worker(username):
+        client = app.test_client()
+        try:
+            client.post("/login", data={"username": username, "password": PASSWORD})
+            mine = targets[:]
+            random.shuffle(mine)
+            barrier.wait()
+            for kind, url, target_id in mine:
+                resp = client.post(url)
+                if resp.status_code == 302 and resp.headers["Location"].endswith(success_path):
+                    with lock:
+                        winners[(kind, target_id)].append(username)
+                elif resp.status_code != 302:
+                    with lock:
+                        errors.append("%s %s -> HTTP %d" % (username, url, resp.status_code))
+        except Exception as e:  # 线程内异常汇总后统一报告
+            with lock:
+                errors.append("%s: %r" % (username, e))
+            barrier.abort()
+
+    threads = [threading.Thread(target=worker, args=(name,)) for name in usernames]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return winners, errors
+
+
+def verify(appmod, winners, order_ids, request_ids, customer_id):
+    """核对：每个目标恰好一名赢家且与库中 player_id 一致，顾客通知条数等于认领成功数。返回问题列表。"""
+    from models import db, User, Order, CustomOfferRequest, Notification
+
+    problems = []
+    names = dict(db.session.query(User.id, User.username).all())
+    owners = dict(db.session.query(Order.id, Order.player_id).filter(Order.id.in_(order_ids)).all())
+    owners_req = dict(db.session.query(CustomOfferRequest.id, CustomOfferRequest.player_id).filter(
+        CustomOfferRequest.id.in_(request_ids)).all())
+    for (kind, target_id), got in sorted(winners.items()):
+        owner = (owners if kind == "order" else owners_req).get(target_id)
+        if len(got) != 1:
+            problems.append("%s %d 被 %d 人接到：%s" % (kind, target_id, len(got), got))
+        elif names.get(owner) != got[0]:
+            problems.append("%s %d 库中归属 %s，但接单成功的是 %s" % (kind, target_id, names.get(owner), got[0]))
+    succeeded = sum(len(got) for got in winners.values())
+    notified = Notification.query.filter(
+        Notification.customer_id == customer_id,
+        Notification.type.in_(["状态变更", "意向已接单"])
+    ).count()
+    expected = len(order_ids) + len(request_ids)
+    if succeeded != expected:
+        problems.append("认领成功 %d 次，应为 %d" % (succeeded, expected))
+    if notified != expected:
+        problems.append("顾客通知 %d 条，应为 %d" % (notified, expected))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="接单条件更新并发压测")
+    parser.add_argument("--threads", type=int, default=16, help="并发打手线程数")
+    parser.add_argument("--orders", type=int, default=5, help="每轮的订单数（意向数相同）")
+    parser.add_argument("--rounds", type=int, default=3, help="压测轮数")
+    parser.add_argument("--database-url", default=None, help="测试库地址（默认临时 SQLite）")
+    args = parser.parse_args(argv)
+
+    tmp = setup_environment(args.database_url)
+    try:
+        import app as appmod
+        appmod.app.config["WTF_CSRF_ENABLED"] = False
+        failed = 0
+        for round_no in range(1, args.rounds + 1):
+            with appmod.app.app_context():
+                usernames, order_ids, request_ids, customer_id = seed(appmod, round_no, args.threads, args.orders)
+            winners, errors = race(appmod, usernames, order_ids, request_ids)
+            with appmod.app.app_context():
+                problems = errors + verify(appmod, winners, order_ids, request_ids, customer_id)
+            print("第 %d 轮：%d 线程抢 %d 单 + %d 个意向，%s" % (
+                round_no, args.threads, len(order_ids), len(request_ids), "通过" if not problems else "失败"))
+            for p in problems:
+                print("  " + p)
+            failed += bool(problems)
+        return 1 if failed else 0
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())